@@ -0,0 +1,392 @@
+## Benchmark nanoscope without any hardware. A simulated Nano streams samples in
+## the same format as nanoscope.ino, and nanoscope runs as usual on the other
+## end of the connection. Results are written as JSON so that runs can be compared.
+
+## Benchmark the defaults for 10 seconds
+## python3 ./benchmark.py
+
+## Benchmark a faster Nano that slips a byte every 5000 samples, without a display
+## python3 ./benchmark.py --rate 50000 --slip 5000 --offscreen --output fast.json
+
+## Benchmark the framed protocol, losing a frame every 100 and a byte every 5000 samples
+## python3 ./benchmark.py --framed --drop 100 --slip 5000
+
+## Benchmark XY mode on two simulated Nanos, a quarter of a cycle apart
+## python3 ./benchmark.py --channels 2 --xy
+
+## Any other options are passed on to nanoscope
+## python3 ./benchmark.py --zoom 0.1 --pretrigger 50
+
+import argparse
+import json
+import os
+import platform
+import runpy
+import sys
+import threading
+import time
+import numpy
+import serial
+
+parser = argparse.ArgumentParser(description='nanoscope benchmark - measure nanoscope against a simulated Arduino Nano.')
+parser.add_argument('--rate', dest='rate', default=10000, type=int, help='Samples per second for the simulated Nano to send')
+parser.add_argument('--frequency', dest='frequency', default=50, type=float, help='Frequency of the simulated sine wave')
+parser.add_argument('--slip', dest='slip', default=0, type=int, help='Drop a byte every this many samples, to test resyncing (0 for never)')
+parser.add_argument('--framed', dest='framed', default=False, action='store_true', help='Send samples in frames, as nanoscope.ino does with FRAMED set')
+parser.add_argument('--drop', dest='drop', default=0, type=int, help='[framed] Leave out a whole frame every this many frames, to test drop detection (0 for never)')
+parser.add_argument('--seconds', dest='seconds', default=10, type=float, help='How long to run for')
+parser.add_argument('--offscreen', dest='offscreen', default=False, action='store_true', help='Render without a display')
+parser.add_argument('--channels', dest='channels', default=1, type=int, help='How many simulated Nanos to run, each a quarter of a cycle behind the one before')
+parser.add_argument('--ports', dest='ports', nargs=2, action='append', metavar=('READ', 'WRITE'), help='Two ends of a virtual null-modem cable to use instead of a pty (i.e.: on Windows). Repeat for each channel.')
+parser.add_argument('--output', dest='output', default='benchmark.json', type=str, help='Path to write results to')
+
+args, nanoscopeArgs = parser.parse_known_args()
+
+if args.channels < 1:
+    parser.error("--channels must be at least 1")
+if args.ports is not None and len(args.ports) != args.channels:
+    parser.error("--ports must be given once for each of the " + str(args.channels) + " channels")
+
+import pyglet
+pyglet.options['headless'] = args.offscreen
+
+## Spikes go above anything the sine wave reaches, so that we can see when they
+## make it onto the screen
+spikeValue = 1023
+spikeInterval = 0.25
+
+## Frames as nanoscope.ino sends them
+frameSync = numpy.frombuffer(b"\xa5\x5a", dtype = numpy.uint8)
+frameSamples = 128
+
+def percentiles(values):
+    if len(values) == 0:
+        return None
+
+    values = numpy.asarray(values) * 1000
+    return {
+        "p50": float(numpy.percentile(values, 50)),
+        "p90": float(numpy.percentile(values, 90)),
+        "p99": float(numpy.percentile(values, 99)),
+        "max": float(values.max())
+    }
+
+def encodeFrames(values, firstSequence):
+
+    ## Pack every 4 samples into 5 bytes, high bits first, and wrap each frame's
+    ## worth in its sync marker, sequence number and Fletcher-16 checksum
+    groups = values.astype(numpy.uint64).reshape(-1, 4)
+    packed = (groups[:, 0] << 30) | (groups[:, 1] << 20) | (groups[:, 2] << 10) | groups[:, 3]
+    payloads = ((packed[:, None] >> numpy.array([32, 24, 16, 8, 0], dtype = numpy.uint64)) & 255).astype(numpy.uint8)
+    payloads = payloads.reshape(-1, frameSamples * 5 // 4)
+
+    sequences = (firstSequence + numpy.arange(len(payloads))) % 65536
+    bodies = numpy.hstack((numpy.stack((sequences >> 8, sequences & 255), axis = 1).astype(numpy.uint8), payloads))
+
+    weights = numpy.arange(bodies.shape[1], 0, -1)
+    first = bodies.astype(numpy.int64).sum(axis = 1) % 255
+    second = (bodies.astype(numpy.int64) * weights).sum(axis = 1) % 255
+    checksums = numpy.stack((second, first), axis = 1).astype(numpy.uint8)
+
+    return numpy.hstack((numpy.tile(frameSync, (len(bodies), 1)), bodies, checksums))
+
+def generateSamples(firstSample, count, phase = 0):
+
+    ## Samples as the Nano would send them, with a spike every spikeInterval
+    indices = numpy.arange(firstSample, firstSample + count)
+    values = (512 + 400 * numpy.sin(2 * numpy.pi * args.frequency * indices / args.rate - phase)).astype(">u2")
+
+    spikeSamples = int(spikeInterval * args.rate)
+    values[indices % spikeSamples == 0] = spikeValue
+
+    if args.framed:
+        ## Leave out the dropped frames entirely. A slip corrupts the frame it's in.
+        frames = encodeFrames(values, firstSample // frameSamples)
+        sequences = firstSample // frameSamples + numpy.arange(len(frames))
+        kept = numpy.ones(len(frames), dtype = bool)
+        if args.drop > 0:
+            kept = sequences % args.drop != args.drop // 2
+
+        corrupted = numpy.zeros(len(frames), dtype = bool)
+        if args.slip > 0:
+            corrupted = numpy.any((indices % args.slip == args.slip // 2).reshape(-1, frameSamples), axis = 1) & kept
+
+        keep = numpy.ones(frames.shape, dtype = bool)
+        keep[~kept] = False
+        keep[corrupted, 10] = False
+        data = frames[keep]
+
+        return data.tobytes(), numpy.any(values == spikeValue), {"slips": int(corrupted.sum()), "drops": int((~kept).sum())}
+
+    data = numpy.frombuffer(values.tobytes(), dtype = numpy.uint8)
+
+    ## Drop the high byte of every slipped sample, as a noisy line would
+    slips = 0
+    if args.slip > 0:
+        keep = numpy.ones(len(data), dtype = bool)
+        slipped = numpy.flatnonzero((indices % args.slip == args.slip // 2) & (values != spikeValue))
+        keep[2 * slipped] = False
+        data = data[keep]
+        slips = len(slipped)
+
+    return data.tobytes(), numpy.any(values == spikeValue), {"slips": slips, "drops": 0}
+
+def simulateNano(write, stats, phase):
+
+    ## Send samples at the configured rate, in small chunks like a USB serial adapter
+    startTime = time.perf_counter()
+    sampleIndex = 0
+
+    while stats["running"]:
+        due = int((time.perf_counter() - startTime) * args.rate)
+        if args.framed:
+            due = due - due % frameSamples
+        if due <= sampleIndex:
+            time.sleep(0.002)
+            continue
+
+        data, hasSpike, faults = generateSamples(sampleIndex, due - sampleIndex, phase)
+        write(data)
+
+        stats["bytesSent"] = stats["bytesSent"] + len(data)
+        stats["samplesSent"] = due
+        stats["slips"] = stats["slips"] + faults["slips"]
+        stats["drops"] = stats["drops"] + faults["drops"]
+        if hasSpike:
+            stats["spikeTimes"].append(time.perf_counter())
+
+        sampleIndex = due
+
+## Connect the simulated Nanos. A pty behaves like the USB serial port of a real
+## one, right down to the kernel's buffering.
+def connectNano(number):
+    if args.ports is not None:
+        feedPort = serial.Serial(args.ports[number][1], 230400)
+        return args.ports[number][0], feedPort.write
+
+    import pty
+    import tty
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    return os.ttyname(slave), lambda data: os.write(master, data)
+
+inputPaths = []
+feeds = []
+for number in range(args.channels):
+    inputPath, feed = connectNano(number)
+    inputPaths.append(inputPath)
+    feeds.append(feed)
+
+allStats = [{
+    "running": True,
+    "bytesSent": 0,
+    "samplesSent": 0,
+    "slips": 0,
+    "drops": 0,
+    "spikeTimes": []
+} for number in range(args.channels)]
+stats = allStats[0]
+
+frames = {
+    "begin": None,
+    "durations": [],
+    "intervals": [],
+    "triggerDurations": [],
+    "latencies": [],
+    "spikeVisible": False
+}
+
+def benchmarkDecode(scope, peak):
+
+    ## Decode a second's worth of the simulated stream, slips and all
+    count = max(args.rate, 100000)
+    data, hasSpike, faults = generateSamples(0, count - count % frameSamples)
+    repeats = 20
+
+    begin = time.perf_counter()
+    for repeat in range(repeats):
+        if args.framed:
+            framing = {"sequence": None, "gap": 0, "dropped": 0, "corrupt": 0, "last": 0}
+            samples, consumed = scope["decodeFrames"](data, framing)
+        else:
+            samples, consumed, skipped = scope["decodeSamples"](data, peak)
+    elapsed = time.perf_counter() - begin
+
+    if args.framed:
+        return {
+            "samplesPerSecond": len(samples) * repeats / elapsed,
+            "framesDropped": framing["dropped"],
+            "framesCorrupt": framing["corrupt"],
+            "dropsInjected": faults["drops"],
+            "slipsInjected": faults["slips"]
+        }
+
+    return {
+        "samplesPerSecond": len(samples) * repeats / elapsed,
+        "bytesResynced": int(skipped),
+        "slipsInjected": faults["slips"]
+    }
+
+def benchmarkProcessing(scope, channel):
+
+    ## Average a second's worth of samples by 4, then low-pass, high-pass and
+    ## remove DC from them, in chunks the size of a typical read
+    values = (512 + 400 * numpy.sin(2 * numpy.pi * args.frequency * numpy.arange(max(args.rate, 100000)) / args.rate)).astype(numpy.uint16)
+    chunks = numpy.array_split(values, len(values) // 1000)
+    repeats = 20
+
+    processing = {key: channel[key] for key in ["average", "lowpass", "highpass", "dcRemove"]}
+    scope["setProcessing"](channel, average = 4, lowpass = args.rate / 20, highpass = args.rate / 1000, dcRemove = True)
+
+    begin = time.perf_counter()
+    for repeat in range(repeats):
+        for chunk in chunks:
+            scope["processSamples"](channel, chunk)
+    elapsed = time.perf_counter() - begin
+
+    scope["setProcessing"](channel, **processing)
+    return {
+        "samplesPerSecond": len(values) * repeats / elapsed
+    }
+
+def benchmarkTrigger(findTriggers, peak):
+
+    ## Search as many samples as nanoscope does for each frame
+    values = 512 + 400 * numpy.sin(2 * numpy.pi * args.frequency * numpy.arange(100000) / args.rate)
+    repeats = 20
+
+    begin = time.perf_counter()
+    for repeat in range(repeats):
+        findTriggers(values, peak / 5, 0, True)
+    elapsed = time.perf_counter() - begin
+
+    return {
+        "samplesPerSecond": len(values) * repeats / elapsed
+    }
+
+runNanoscope = pyglet.app.run
+
+def runBenchmark(interval = 1/60):
+
+    ## nanoscope calls this once everything is set up, so its globals are the
+    ## caller's. Time its frames and the stages within them, then let it run.
+    scope = sys._getframe(1).f_globals
+    window = scope["window"]
+    channel = scope["channels"][0]
+    trace = scope["traces"][0]
+
+    positionFrame = scope["positionFrame"]
+    def timedPositionFrame(iterCount):
+        begin = time.perf_counter()
+        result = positionFrame(iterCount)
+        frames["triggerDurations"].append(time.perf_counter() - begin)
+        return result
+    scope["positionFrame"] = timedPositionFrame
+
+    def on_draw():
+        now = time.perf_counter()
+        if frames["begin"] is not None:
+            frames["intervals"].append(now - frames["begin"])
+        frames["begin"] = now
+
+    def on_refresh(dt):
+
+        ## Wait for the GPU, so that this is when the pixels are there
+        pyglet.gl.glFinish()
+        now = time.perf_counter()
+        frames["durations"].append(now - frames["begin"])
+
+        ## Latency is from the last spike's bytes being written to it being drawn.
+        ## XY mode doesn't draw the first channel's trace, so it isn't measured there.
+        visible = False
+        if trace["count"] > 0:
+            positions = numpy.ctypeslib.as_array(trace["vertexList"].position).reshape(-1, 2)
+            spikeY = (spikeValue - 10) / channel["inputPeak"] * channel["scale"] * (window.height - 80) + 40
+            visible = positions[:trace["count"], 1].max() >= spikeY
+
+        if visible and not frames["spikeVisible"] and len(stats["spikeTimes"]) > 0:
+            frames["latencies"].append(now - stats["spikeTimes"][-1])
+        frames["spikeVisible"] = visible
+
+    window.push_handlers(on_draw = on_draw, on_refresh = on_refresh)
+
+    senders = [threading.Thread(target = simulateNano, args = (feeds[number], allStats[number], number * numpy.pi / 2), daemon = True)
+               for number in range(args.channels)]
+    for sender in senders:
+        sender.start()
+    pyglet.clock.schedule_once(lambda dt: pyglet.app.exit(), args.seconds)
+
+    begin = time.perf_counter()
+    samplesBegin = [channel["samplesRead"] for channel in scope["channels"]]
+    runNanoscope(interval)
+    elapsed = time.perf_counter() - begin
+
+    ## Give the readers a moment to drain whatever is still in flight
+    for number, sender in enumerate(senders):
+        allStats[number]["running"] = False
+        sender.join()
+    time.sleep(0.5)
+
+    acquisition = [{
+        "samplesPerSecond": (scopeChannel["samplesRead"] - samplesBegin[number]) / elapsed,
+        "samplesSent": allStats[number]["samplesSent"],
+        "samplesRead": scopeChannel["samplesRead"],
+        "bytesSent": allStats[number]["bytesSent"],
+        "bytesDropped": allStats[number]["bytesSent"] - scopeChannel["sampleTotal"],
+        "bytesResynced": scopeChannel["bytesSkipped"],
+        "protocol": scopeChannel["protocol"],
+        "framesDropped": scopeChannel["framing"]["dropped"],
+        "framesCorrupt": scopeChannel["framing"]["corrupt"],
+        "dropsInjected": allStats[number]["drops"],
+        "slipsInjected": allStats[number]["slips"]
+    } for number, scopeChannel in enumerate(scope["channels"])]
+
+    results = {
+        "config": {
+            "rate": args.rate,
+            "frequency": args.frequency,
+            "slip": args.slip,
+            "framed": args.framed,
+            "drop": args.drop,
+            "channels": args.channels,
+            "seconds": args.seconds,
+            "offscreen": args.offscreen,
+            "nanoscope": nanoscopeArgs
+        },
+        "system": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "pyglet": pyglet.version
+        },
+        "acquisition": acquisition[0] if args.channels == 1 else acquisition,
+        "decode": benchmarkDecode(scope, channel["inputPeak"]),
+        "processing": benchmarkProcessing(scope, channel),
+        "trigger": dict(benchmarkTrigger(scope["findTriggers"], channel["inputPeak"]),
+                        frameMilliseconds = percentiles(frames["triggerDurations"])),
+        "render": {
+            "frames": len(frames["durations"]),
+            "framesPerSecond": len(frames["durations"]) / elapsed,
+            "frameMilliseconds": percentiles(frames["durations"]),
+            "intervalMilliseconds": percentiles(frames["intervals"])
+        },
+        "latency": {
+            "spikes": len(frames["latencies"]),
+            "milliseconds": percentiles(frames["latencies"])
+        }
+    }
+
+    with open(args.output, "w") as outputFile:
+        json.dump(results, outputFile, indent = 2)
+
+    print()
+    print(json.dumps(results, indent = 2))
+
+pyglet.app.run = runBenchmark
+
+## Options given before the inputs apply to every channel
+sys.argv = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "nanoscope.py"),
+            "--rate", "230400", "--samplerate", str(args.rate)] + nanoscopeArgs
+for inputPath in inputPaths:
+    sys.argv = sys.argv + ["--input", inputPath]
+runpy.run_path(sys.argv[0], run_name = "__main__")
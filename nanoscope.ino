@@ -1,12 +1,60 @@
+// Set FRAMED to 1 to send samples in frames rather than as raw pairs of bytes.
+// Each frame is a sync marker, a sequence number, FRAME_SAMPLES samples packed
+// 4 to every 5 bytes, and a Fletcher-16 checksum. The same baud rate carries
+// about half as many samples again, and nanoscope can tell exactly how many
+// frames were lost. nanoscope detects which way the samples are sent.
+#define FRAMED 0
+#define FRAME_SAMPLES 128
+
+uint16_t sequence = 0;
+uint16_t sum1 = 0;
+uint16_t sum2 = 0;
+
 void setup() {
   Serial.begin(230400);
   pinMode(A0, INPUT);  
 }
 
+// Send a byte of a frame, adding it to the frame's checksum
+void sendByte(uint8_t value) {
+  Serial.write(value);
+  sum1 = (sum1 + value) % 255;
+  sum2 = (sum2 + sum1) % 255;
+}
+
 void loop() {
+#if FRAMED
+  Serial.write(0xA5);
+  Serial.write(0x5A);
+
+  sum1 = 0;
+  sum2 = 0;
+  sendByte(sequence >> 8);
+  sendByte(sequence & 0xFF);
+
+  // Send each group of 4 samples as soon as we have it, so that sampling
+  // carries on while the bytes go out
+  for (int i = 0; i < FRAME_SAMPLES; i += 4) {
+    uint16_t a = analogRead(A0);
+    uint16_t b = analogRead(A0);
+    uint16_t c = analogRead(A0);
+    uint16_t d = analogRead(A0);
+
+    sendByte(a >> 2);
+    sendByte(((a & 0x03) << 6) | (b >> 4));
+    sendByte(((b & 0x0F) << 4) | (c >> 6));
+    sendByte(((c & 0x3F) << 2) | (d >> 8));
+    sendByte(d & 0xFF);
+  }
+
+  Serial.write(sum2);
+  Serial.write(sum1);
+  sequence++;
+#else
   int measurement = analogRead(A0);
 
   // Transmit the integer as two bytes, big-endian
   Serial.write((measurement & 0xFF00) >> 8);
   Serial.write(measurement & 0xFF);
+#endif
 }
@@ -10,485 +10,3190 @@
 ## Display two channels (one on COM7 and one on COM9)
 ## python ./nanoscope.py --input COM7 --rate 230400 --input2 COM9 --rate2 230400
 
+## Display four channels, all at rate 230400, lined up by cross-correlating a shared test signal
+## python ./nanoscope.py --rate 230400 --input COM7 --input COM8 --input COM9 --input COM10 --align xcorr
+
+## Show the frequency spectrum of a channel, reading levels accurately with a flat top window
+## python ./nanoscope.py --input COM7 --rate 230400 --spectrum --fftsize 16384 --fftwindow flattop
+
+## Average every 16 samples into one for two more bits of resolution, and low-pass filter them at 100Hz
+## python ./nanoscope.py --input COM7 --rate 230400 --average 16 --lowpass 100
+
+## Write measurements of captured data for every 100ms, without a display
+## python ./nanoscope.py --input output.dat --headless --window 100ms --output measurements.csv
+
 ## Oscillofun:
 ## Assuming COM7 = Left Channel, COM9 = Right Channel
 ## python ./nanoscope.py --input COM7 --rate 230400 --invert --offset -100 --input2 COM9 --invert2 --offset2 -220 --rate2 230400 --xy
 
-import pyglet
 import math
 import serial
 import argparse
 import time
-
-from pyglet import shapes
-from pyglet.gl import *
-from pyglet.window import mouse
-from pyglet.window import key
+import threading
+import numpy
+import mmap
+import os
+import json
+import queue
+import struct
+import sys
+import csv
+import http.server
+import tempfile
+import asyncio
+import socket
+import hashlib
+import base64
+import select
+
+class ChannelOption(argparse.Action):
+
+    ## Options given before the first --input apply to every channel. After that,
+    ## they apply to the channel of the --input before them.
+    def __call__(self, parser, namespace, values, option_string = None):
+        if self.nargs == 0:
+            values = self.const
+
+        if self.dest == "input":
+            namespace.inputs.append({"input": values})
+        elif len(namespace.inputs) > 0:
+            namespace.inputs[-1][self.dest] = values
+        else:
+            setattr(namespace, self.dest, values)
 
 parser = argparse.ArgumentParser(description='nanoscope - a simple viewer for streaming serial input data.')
-parser.add_argument('--input', required=True, dest='input', type=str, help='Path to input serial data stream')
-parser.add_argument('--peak', dest='peak', default=1024, type=int, help='Maximum possible value of input data points')
-parser.add_argument('--rate', dest='rate', type=int, help='Baud rate of input serial data stream')
-parser.add_argument('--vref', dest='vref', default=5, type=float, help='Voltage value when at input peak')
-parser.add_argument('--scale', dest='scale', default=1, type=float, help='Vertical zoom to apply to data view')
-parser.add_argument('--zoom', dest='zoom', default=1, type=float, help='Horizontal zoom to apply to data view')
-parser.add_argument('--offset', dest='offset', default=0, type=int, help='Offset to apply to data view')
-parser.add_argument('--trigger', dest='trigger', default=1, type=float, help='Trigger point (in either volts or raw data value)')
-parser.add_argument('--invert', dest='invert', default=False, action='store_true', help='Whether to invert the channel')
-parser.add_argument('--capture', dest='capture', type=str, help='Path to capture data stream to')
-
-parser.add_argument('--input2', dest='input2', type=str, help='[2nd channel] Path to input serial data stream')
+parser.set_defaults(inputs = [])
+parser.add_argument('--input', required=True, dest='input', type=str, action=ChannelOption, help='Serial port, capture or WAV file (file.wav#2 for its 2nd channel), - for standard input, or tcp://host:port of another nanoscope\'s --serve. Repeat for more channels.')
+parser.add_argument('--peak', dest='peak', default=1024, type=int, action=ChannelOption, help='Maximum possible value of input data points')
+parser.add_argument('--rate', dest='rate', type=int, action=ChannelOption, help='Baud rate of input serial data stream')
+parser.add_argument('--vref', dest='vref', default=5, type=float, action=ChannelOption, help='Voltage value when at input peak')
+parser.add_argument('--scale', dest='scale', default=1, type=float, action=ChannelOption, help='Vertical zoom to apply to data view')
+parser.add_argument('--zoom', dest='zoom', default=1, type=float, action=ChannelOption, help='Horizontal zoom to apply to data view')
+parser.add_argument('--offset', dest='offset', default=0, type=int, action=ChannelOption, help='Offset to apply to data view')
+parser.add_argument('--trigger', dest='trigger', default=1, type=float, action=ChannelOption, help='Trigger point (in either volts or raw data value)')
+parser.add_argument('--invert', dest='invert', default=False, nargs=0, const=True, action=ChannelOption, help='Whether to invert the channel')
+parser.add_argument('--capture', dest='capture', type=str, action=ChannelOption, help='Path to capture data stream to')
+parser.add_argument('--samplerate', dest='samplerate', default=10000, type=float, action=ChannelOption, help='Samples per second of input data, for times given in seconds')
+parser.add_argument('--average', dest='average', default=1, type=int, action=ChannelOption, help='Average every this many samples of a live input (not a capture or WAV file) into one, for more resolution and less noise (up to 64, cycle with R)')
+parser.add_argument('--lowpass', dest='lowpass', type=float, action=ChannelOption, help='Low-pass filter a live input (not a capture or WAV file) at this frequency, in Hz (toggle with L)')
+parser.add_argument('--highpass', dest='highpass', type=float, action=ChannelOption, help='High-pass filter a live input (not a capture or WAV file) at this frequency, in Hz (toggle with H)')
+parser.add_argument('--dcremove', dest='dcremove', default=False, nargs=0, const=True, action=ChannelOption, help='Remove the DC level of a live input (not a capture or WAV file), centering it (toggle with D)')
+
+parser.add_argument('--input2', dest='input2', type=str, help='[2nd channel] Serial port, capture or WAV file, - for standard input, or tcp://host:port')
 parser.add_argument('--peak2', dest='peak2', default=1024, type=int, help='[2nd channel] Maximum possible value of input data points')
 parser.add_argument('--rate2', dest='rate2', type=int, help='[2nd channel] Baud rate of input serial data stream')
 parser.add_argument('--vref2', dest='vref2', default=5, type=float, help='[2nd channel] Voltage value when at input peak')
 parser.add_argument('--scale2', dest='scale2', default=1, type=float, help='[2nd channel] Vertical zoom to apply to data view')
 parser.add_argument('--zoom2', dest='zoom2', default=1, type=float, help='[2nd channel] Horizontal zoom to apply to data view')
 parser.add_argument('--offset2', dest='offset2', default=0, type=int, help='[2nd channel] Offset to apply to data view')
+parser.add_argument('--trigger2', dest='trigger2', default=1, type=float, help='[2nd channel] Trigger point (in either volts or raw data value)')
 parser.add_argument('--invert2', dest='invert2', default=False, action='store_true', help='[2nd channel] Whether to invert the channel')
 parser.add_argument('--capture2', dest='capture2', type=str, help='[2nd channel] Path to capture data stream to')
+parser.add_argument('--samplerate2', dest='samplerate2', default=10000, type=float, help='[2nd channel] Samples per second of input data, for times given in seconds')
 
+parser.add_argument('--protocol', dest='protocol', default='auto', choices=['auto', 'raw', 'framed'], help='How serial ports send their samples: raw two-byte samples, or frames (see nanoscope.ino). Detected by default.')
+parser.add_argument('--depth', dest='depth', default='65536', type=str, help='How much history to keep in memory for each serial port (sample count, time such as 60s, or size such as 16MB)')
+parser.add_argument('--history', dest='history', type=str, help='Keep this much history for each serial port in a temporary file instead, to scroll back through (sample count, time such as 600s, or size such as 500MB)')
 parser.add_argument('--oneshot', dest='oneshot', default=False, action='store_true', help='Stop capturing once trigger point has hit')
+parser.add_argument('--triggerchannel', dest='triggerchannel', default=1, type=int, help='Which channel to trigger on')
+parser.add_argument('--align', dest='align', default='timestamps', choices=['timestamps', 'xcorr'], help='How to line up serial channels: by when their data arrives, or also by cross-correlating a test signal they all measure')
+parser.add_argument('--edge', dest='edge', default='rising', choices=['rising', 'falling'], help='Whether to trigger on a rising or falling edge')
+parser.add_argument('--hysteresis', dest='hysteresis', default=0, type=float, help='How far (in volts) the signal must move back past the trigger point before it can trigger again')
+parser.add_argument('--holdoff', dest='holdoff', default=0, type=float, help='Minimum time (in seconds) between triggers')
+parser.add_argument('--pretrigger', dest='pretrigger', default=0, type=float, help='Percentage of the view to show before the trigger point')
+parser.add_argument('--fps', dest='fps', default=60, type=float, help='Most frames per second to draw')
 parser.add_argument('--xy', dest='xy', default=False, action='store_true', help='Display input channels in XY mode')
+parser.add_argument('--persistence', dest='persistence', default=0.1, type=float, help='[XY mode] How long (in seconds) samples take to fade to a third of their brightness, like the phosphor of a CRT')
+parser.add_argument('--spectrum', dest='spectrum', default=False, action='store_true', help='Display the frequency spectrum of each channel')
+parser.add_argument('--fftsize', dest='fftsize', default=8192, type=int, help='[spectrum] How many of the latest samples to transform (up to 65536)')
+parser.add_argument('--fftwindow', dest='fftwindow', default='hann', choices=['hann', 'blackman', 'flattop'], help='[spectrum] Window to apply before transforming: flattop reads levels most accurately, blackman shows the most dynamic range')
+parser.add_argument('--fftaverage', dest='fftaverage', default='exponential', choices=['none', 'exponential', 'peak'], help='[spectrum] How to average spectra over time')
+parser.add_argument('--start', dest='start', type=str, help='Where to start playing back captured data (sample index, or time such as 2.5s)')
+parser.add_argument('--end', dest='end', type=str, help='Where to stop playing back captured data (sample index, or time such as 2.5s)')
+
+parser.add_argument('--serve', dest='serve', type=str, help='Serve the samples of every channel to other nanoscopes (--input tcp://HOST:PORT) and WebSocket clients on HOST:PORT')
+
+parser.add_argument('--overlay', dest='overlay', default=False, action='store_true', help='Show how long each stage of getting samples onto the screen takes (toggle with I)')
+parser.add_argument('--metrics', dest='metrics', type=str, help='Path to append timings and counters to once a second, as JSON lines')
+parser.add_argument('--metricsport', dest='metricsport', type=int, help='Serve timings and counters for Prometheus on this local port, at /metrics')
+
+parser.add_argument('--headless', dest='headless', default=False, action='store_true', help='Write measurements of the input instead of displaying it')
+parser.add_argument('--window', dest='window', default='1s', type=str, help='[headless] How much data to measure at a time (sample count, or time such as 100ms)')
+parser.add_argument('--format', dest='format', default='csv', choices=['csv', 'json'], help='[headless] Write measurements as CSV or JSON lines')
+parser.add_argument('--output', dest='output', type=str, help='[headless] Path to write measurements to (default: standard output)')
 
 args = parser.parse_args()
 
-channels = [{
-    "input": args.input,
-    "peak": args.peak,
-    "rate": args.rate,
-    "vref": args.vref,
-    "scale": args.scale,    
-    "zoom": args.zoom,
-    "offset": args.offset,
-    "trigger": args.trigger,
-    "invert": args.invert,
-    "capture": args.capture,
-
-    "originalTrigger": None,
-    "port": None,
-    "dataBuffer": [0]*10*10000,
-    "dataIndex":  0,
-    "triggerIndex": -1,
-    "oneShotHome": -1,
-    "captureFile": None,
-    "sampleTotal": 0
-}, {
-    "input": args.input2,
-    "peak": args.peak2,
-    "rate": args.rate2,
-    "vref": args.vref2,
-    "scale": args.scale2,    
-    "zoom": args.zoom2,
-    "offset": args.offset2,
-    "trigger": -1,
-    "invert": args.invert2,
-    "capture": args.capture2,
-
-    "originalTrigger": None,
-    "port": None,
-    "dataBuffer": [0]*10*10000,
-    "dataIndex":  0,
-    "triggerIndex": -1,
-    "oneShotHome": -1,
-    "captureFile": None,
-    "sampleTotal": 0
-}]
+channelOptions = ["peak", "rate", "vref", "scale", "zoom", "offset", "trigger", "invert", "capture", "samplerate"]
+processingOptions = ["average", "lowpass", "highpass", "dcremove"]
+
+def parseSamplePosition(value, sampleRate):
+
+    ## Positions can be given as a sample index, or as a time in seconds or
+    ## milliseconds (i.e.: 2.5s or 300ms)
+    if value.endswith("ms"):
+        return int(float(value[:-2]) / 1000 * sampleRate)
+    if value.endswith("s"):
+        return int(float(value[:-1]) * sampleRate)
+
+    return int(value)
+
+def parseBufferSize(value, sampleRate):
+
+    ## Buffers can also be given as a size in bytes (i.e.: 500MB), at two bytes per sample
+    units = {"KB": 1 << 10, "MB": 1 << 20, "GB": 1 << 30}
+    if value[-2:].upper() in units:
+        return int(float(value[:-2]) * units[value[-2:].upper()]) // 2
+
+    return parseSamplePosition(value, sampleRate)
+
+def createChannel(settings):
+    return {
+        "input": settings["input"],
+        "peak": settings["peak"],
+        "rate": settings["rate"],
+        "vref": settings["vref"],
+        "scale": settings["scale"],
+        "zoom": settings["zoom"],
+        "offset": settings["offset"],
+        "trigger": settings["trigger"],
+        "invert": settings["invert"],
+        "capture": settings["capture"],
+        "sampleRate": settings["samplerate"],
+        "start": args.start,
+        "end": args.end,
+
+        "originalTrigger": None,
+        "port": None,
+        "dataBuffer": numpy.zeros(max(1, parseBufferSize(args.depth, settings["samplerate"])), dtype = numpy.uint16),
+        "dataIndex":  0,
+        "triggerIndex": -1,
+        "frameIndex": 0,
+        "lastTrigger": None,
+        "triggerCarry": None,
+        "windowSize": 0,
+        "windowCapped": False,
+        "playStart": 0,
+        "oneShotHome": -1,
+        "captureFile": None,
+        "captureQueue": None,
+        "captureWriter": None,
+        "samplesNotCaptured": 0,
+        "startTime": None,
+        "sampleTotal": 0,
+
+        "reader": None,
+        "reading": False,
+        "dataReady": threading.Condition(),
+        "writeIndex": 0,
+        "samplesWaiting": 0,
+        "samplesNew": 0,
+        "samplesFilled": 0,
+        "samplesRead": 0,
+        "bytesSkipped": 0,
+        "bytesDiscarded": 0,
+        "samplesDiscarded": 0,
+        "protocol": args.protocol,
+        "framing": {"sequence": None, "gap": 0, "dropped": 0, "corrupt": 0, "last": 0},
+        "pyramid": None,
+        "pyramidFilled": 0,
+        "dataMap": None,
+        "historyFile": None,
+        "blockTimes": None,
+        "samplesServed": 0,
+        "streamChannel": 0,
+        "streamPending": b"",
+        "streamNext": None,
+        "samplesMissing": 0,
+        "source": None,
+        "readBytes": None,
+        "waitsForAnalysis": False,
+        "samplesSkipped": 0,
+        "inputEnded": False,
+        "inputPeak": settings["peak"],
+        "sampleScale": 1,
+        "average": 1,
+        "lowpass": None,
+        "highpass": None,
+        "dcRemove": False,
+        "lowpassCutoff": settings["lowpass"],
+        "highpassCutoff": settings["highpass"],
+        "processing": None,
+        "requestedAverage": settings["average"],
+        "requestedDcRemove": settings["dcremove"],
+        "processingIgnored": False,
+
+        "arrivals": numpy.zeros((4096, 2)),
+        "arrivalCount": 0,
+        "timingRate": settings["samplerate"],
+        "timingSample": 0,
+        "timingStart": None,
+        "timingCorrection": 0.0,
+        "frameShift": 0.0,
+        "frameScale": 1.0,
+        "frameCount": 0,
+
+        "spectrum": None,
+        "spectrumAverage": None,
+        "spectrumSettings": None,
+        "spectrumEnd": None,
+
+        "measurements": None
+    }
+
+channels = []
+for inputSettings in args.inputs:
+    settings = {option: getattr(args, option) for option in channelOptions + processingOptions}
+    settings.update(inputSettings)
+    channels.append(createChannel(settings))
+
+## The second channel can also be given with its own set of options
+if args.input2 is not None:
+    settings = {option: getattr(args, option + "2") for option in channelOptions}
+    settings.update({option: getattr(args, option) for option in processingOptions})
+    settings["input"] = args.input2
+    channels.insert(1, createChannel(settings))
+
+if not 1 <= args.triggerchannel <= len(channels):
+    parser.error("--triggerchannel must be between 1 and " + str(len(channels)))
+
+if args.xy and len(channels) < 2:
+    parser.error("--xy needs two channels")
 
 for channel in channels:
+    if len(channel["dataBuffer"]) < 4096:
+        parser.error("--depth must be at least 4096 samples")
+    if args.history is not None and parseBufferSize(args.history, channel["sampleRate"]) < 4096:
+        parser.error("--history must be at least 4096 samples")
+
+if not 16 <= args.fftsize <= 65536:
+    parser.error("--fftsize must be between 16 and 65536")
+
+def decodeSamples(data, peak):
+
+    ## Decode a chunk of big-endian two-byte integers in one pass. Returns the
+    ## samples, how many bytes were consumed, and how many were skipped to resync.
+    ##
+    ## The Nano doesn't frame its data, so we use the same rule as always: if a
+    ## data point is out of range, we've had a sync error so skip a byte and try
+    ## again. Rather than doing that byte by byte, look at the value starting at
+    ## every byte offset at once, and only step in Python where a bad one shows up.
+    rawData = numpy.frombuffer(data, dtype = numpy.uint8)
+    if len(rawData) < 2:
+        return numpy.zeros(0, dtype = numpy.uint16), 0, 0
+
+    values = (rawData[:-1].astype(numpy.uint16) << 8) | rawData[1:]
+    outOfRange = numpy.flatnonzero(values > peak)
+    outOfRange = [outOfRange[outOfRange % 2 == 0], outOfRange[outOfRange % 2 == 1]]
+
+    samples = []
+    position = 0
+    skipped = 0
+
+    while position < len(values):
+
+        ## Take every value from here up to the next bad one with the same alignment
+        badValues = outOfRange[position % 2]
+        nextBad = numpy.searchsorted(badValues, position)
+        if nextBad < len(badValues):
+            nextBad = badValues[nextBad]
+        else:
+            nextBad = len(values)
+
+        alignedValues = values[position:nextBad:2]
+        samples.append(alignedValues)
+        position = position + 2 * len(alignedValues)
+
+        ## And then skip over the byte that put us out of sync
+        if position == nextBad and nextBad < len(values):
+            position = position + 1
+            skipped = skipped + 1
+
+    return numpy.concatenate(samples), int(position), skipped
+
+## A Nano can also send its samples in frames (see nanoscope.ino). Each frame is
+## a sync marker, a 16 bit sequence number, frameSamples 10 bit samples packed 4
+## to every 5 bytes, and a Fletcher-16 checksum of the sequence number and
+## samples. That's about 1.3 bytes a sample rather than 2, so the same baud rate
+## carries half as many samples again. Raw samples never exceed 1023, so their
+## high byte can't be the second byte of the marker: a raw stream never has one.
+frameSync = b"\xa5\x5a"
+frameSamples = 128
+framePayload = frameSamples * 5 // 4
+frameSize = len(frameSync) + 2 + framePayload + 2
+
+## How much of a port's data to look at before deciding how it's sent
+protocolDetectBytes = 4 * frameSize
+
+def frameChecksum(data):
+
+    ## Fletcher-16, as (sum of sums << 8) | sum
+    data = numpy.asarray(data, dtype = numpy.int64)
+    first = int(data.sum() % 255)
+    second = int(numpy.dot(data, numpy.arange(len(data), 0, -1)) % 255)
+    return (second << 8) | first
+
+def frameValid(rawData, position):
+    frame = rawData[position:position + frameSize]
+    return frameChecksum(frame[2:-2]) == (int(frame[-2]) << 8) | int(frame[-1])
+
+def detectProtocol(data):
+    rawData = numpy.frombuffer(data, dtype = numpy.uint8)
+    position = data.find(frameSync)
+
+    while 0 <= position <= len(rawData) - frameSize:
+        if frameValid(rawData, position):
+            return "framed"
+        position = data.find(frameSync, position + 1)
+
+    return "raw"
+
+def decodeFrames(data, framing):
+
+    ## Decode a chunk of frames. Returns the samples and how many bytes were
+    ## consumed. Whatever doesn't check out is skipped up to the next sync marker.
+    ##
+    ## The sequence numbers say exactly how many frames went missing between two
+    ## good ones. Those we got some bytes of (that failed the checksum) count as
+    ## corrupt, and the rest as dropped. Their samples are filled in with the last
+    ## good one, so that every sample keeps its place in time.
+    rawData = numpy.frombuffer(data, dtype = numpy.uint8)
+    starts = []
+    missing = []
+    position = 0
+
+    while position + frameSize <= len(rawData):
+        if data.startswith(frameSync, position) and frameValid(rawData, position):
+            sequence = (int(rawData[position + 2]) << 8) | int(rawData[position + 3])
+            lost = 0
+            if framing["sequence"] is not None:
+                lost = (sequence - framing["sequence"] - 1) % 65536
+                damaged = min(lost, -(-framing["gap"] // frameSize))
+                framing["corrupt"] = framing["corrupt"] + damaged
+                framing["dropped"] = framing["dropped"] + lost - damaged
+
+            starts.append(position)
+            missing.append(lost)
+            framing["sequence"] = sequence
+            framing["gap"] = 0
+            position = position + frameSize
+            continue
+
+        ## Out of sync: skip to the next marker, keeping a byte that might start one
+        nextSync = data.find(frameSync, position + 1)
+        if nextSync < 0:
+            nextSync = max(position + 1, len(rawData) - 1)
+        framing["gap"] = framing["gap"] + nextSync - position
+        position = nextSync
+
+    if len(starts) == 0:
+        return numpy.zeros(0, dtype = numpy.uint16), position
+
+    ## Unpack every good frame at once. Each 5 bytes hold 4 samples, high bits first.
+    payloads = rawData[numpy.array(starts)[:, None] + 4 + numpy.arange(framePayload)].reshape(-1, 5).astype(numpy.uint64)
+    packed = (payloads[:, 0] << 32) | (payloads[:, 1] << 24) | (payloads[:, 2] << 16) | (payloads[:, 3] << 8) | payloads[:, 4]
+    frames = ((packed[:, None] >> numpy.array([30, 20, 10, 0], dtype = numpy.uint64)) & 1023).astype(numpy.uint16).reshape(len(starts), frameSamples)
+
+    samples = []
+    for frame, lost in zip(frames, missing):
+        if lost > 0:
+            samples.append(numpy.full(lost * frameSamples, framing["last"], dtype = numpy.uint16))
+        samples.append(frame)
+        framing["last"] = frame[-1]
+
+    return numpy.concatenate(samples), position
+
+## To draw zoomed out views quickly, we keep a min/max pyramid over the samples.
+## Each level holds the minimum and maximum of every 4 entries in the level below
+## it, so any span of samples can be drawn as one min/max column per pixel by
+## looking at only a handful of entries per column - and a glitch is never
+## averaged away, however far out we zoom.
+def reduceLevel(mins, maxs, factor):
+    mins = numpy.asarray(mins)
+    maxs = numpy.asarray(maxs)
+
+    ## Pad a partial block at the end with copies of its last entry
+    extra = -len(mins) % factor
+    if extra > 0:
+        mins = numpy.concatenate((mins, numpy.repeat(mins[-1:], extra)))
+        maxs = numpy.concatenate((maxs, numpy.repeat(maxs[-1:], extra)))
+
+    return mins.reshape(-1, factor).min(axis = 1), maxs.reshape(-1, factor).max(axis = 1)
+
+def createPyramid(sampleCount, firstBlockSize):
+
+    ## Allocate the levels, from blocks of firstBlockSize samples up to a single
+    ## block covering everything. Fill them in with updatePyramid().
+    pyramid = []
+    blockSize = firstBlockSize
+
+    while True:
+        blockCount = -(-sampleCount // blockSize)
+        pyramid.append((blockSize, numpy.zeros(blockCount, dtype = numpy.uint16), numpy.zeros(blockCount, dtype = numpy.uint16)))
+
+        if blockCount <= 1:
+            return pyramid
+
+        blockSize = blockSize * 4
+
+def updatePyramid(pyramid, samples, start, count):
+
+    ## Recompute only the blocks that cover the samples that changed
+    mins = samples
+    maxs = samples
+    lowerBlockSize = 1
+
+    for blockSize, levelMins, levelMaxs in pyramid:
+        if count <= 0:
+            break
 
-    ## Adjust trigger if they specified something in volts
-    if channel["trigger"] < 10:
-        channel["trigger"] = channel["trigger"] / channel["vref"] * channel["peak"]
-        channel["originalTrigger"] = channel["trigger"]
+        factor = blockSize // lowerBlockSize
+        firstBlock = start // factor
+        lastBlock = (start + count - 1) // factor + 1
+        levelMins[firstBlock:lastBlock], levelMaxs[firstBlock:lastBlock] = reduceLevel(
+            mins[firstBlock * factor:lastBlock * factor], maxs[firstBlock * factor:lastBlock * factor], factor)
 
-    if channel["input"] is not None:      
-        if (channel["input"].lower().startswith("/dev") or channel["input"].lower().startswith("com")) and channel["rate"] is None:
-            raise Exception("Specify a serial rate for " + channel["input"])
+        mins = levelMins
+        maxs = levelMaxs
+        lowerBlockSize = blockSize
+        start = firstBlock
+        count = lastBlock - firstBlock
+
+def queryPyramid(pyramid, samples, start, count, columns):
+
+    ## Find the coarsest level that still has at least one entry per column
+    mins = samples
+    maxs = samples
+    blockSize = 1
+
+    for levelBlockSize, levelMins, levelMaxs in pyramid:
+        if levelBlockSize > count / columns:
+            break
+
+        mins = levelMins
+        maxs = levelMaxs
+        blockSize = levelBlockSize
+
+    ## And then combine the few entries that fall into each column. The data
+    ## buffer is a ring, so the span may wrap around its end.
+    firstBlock = start // blockSize
+    blockCount = (start + count - 1) // blockSize - firstBlock + 1
+    blocks = (firstBlock + numpy.arange(blockCount)) % len(mins)
+    columnStarts = (numpy.arange(columns) * blockCount) // columns
+
+    return numpy.minimum.reduceat(mins[blocks], columnStarts), numpy.maximum.reduceat(maxs[blocks], columnStarts)
+
+## Processing. Samples from live inputs can be averaged and filtered as they
+## arrive, before they're kept, captured or served, so everything downstream
+## sees them the same way. Ports and pipes keep their samples with extra bits
+## below the ADC's (sampleScale times its values), so that the resolution that
+## averaging and filtering gain isn't rounded away.
+##
+## Averaging adds up every average samples into one, like the high resolution
+## mode of a bench scope: 4 samples gain a bit, 16 gain two. The filters are
+## one-pole IIRs, and DC removal is a high-pass slow enough to leave everything
+## but the DC level alone. High-passed samples are centred on half the peak.
+## All of them keep their state from one read to the next.
+maxAverage = 64
+dcRemovalTime = 1.0
+defaultLowpass = 0.05
+defaultHighpass = 0.001
+
+def startProcessing(channel):
+    if not 1 <= channel["requestedAverage"] <= maxAverage:
+        parser.error("--average must be between 1 and " + str(maxAverage))
+    for cutoff in [channel["lowpassCutoff"], channel["highpassCutoff"]]:
+        if cutoff is not None and cutoff <= 0:
+            parser.error("--lowpass and --highpass must be above 0Hz")
+
+    ## Live inputs that decode their own samples get the extra bits. Streams
+    ## already have them from the nanoscope serving them.
+    if channel["readBytes"] is not None:
+        channel["sampleScale"] = 2 ** int(math.log2(max(1, 65536 // channel["peak"])))
+        channel["peak"] = channel["peak"] * channel["sampleScale"]
+        channel["offset"] = channel["offset"] * channel["sampleScale"]
+
+    setProcessing(channel, average = channel["requestedAverage"], lowpass = channel["lowpassCutoff"],
+                  highpass = channel["highpassCutoff"], dcRemove = channel["requestedDcRemove"])
+
+def setProcessing(channel, **settings):
+
+    ## Change how a channel's samples are processed, starting its filters again.
+    ## Averaging changes the sample rate, so its timing is measured again too.
+    average = settings.get("average", channel["average"])
+    with channel["dataReady"]:
+        channel["sampleRate"] = channel["sampleRate"] * channel["average"] / average
+        channel["timingRate"] = channel["timingRate"] * channel["average"] / average
+        if average != channel["average"]:
+            channel["arrivalCount"] = 0
+
+        channel.update(settings)
+        channel["processing"] = {"pending": numpy.zeros(0), "lowpass": None, "highpass": None, "dcRemove": None}
+
+def describeProcessing(channel):
+
+    ## Files play back as they were recorded, so say so if asked to process one
+    if channel["processingIgnored"]:
+        return " (played back unprocessed)"
+
+    parts = []
+    if channel["average"] > 1:
+        parts.append("average " + str(channel["average"]))
+    if channel["lowpass"] is not None:
+        parts.append("low-pass " + format(channel["lowpass"], ".4g") + "Hz")
+    if channel["highpass"] is not None:
+        parts.append("high-pass " + format(channel["highpass"], ".4g") + "Hz")
+    if channel["dcRemove"]:
+        parts.append("DC removed")
+
+    return "" if len(parts) == 0 else " (" + ", ".join(parts) + ")"
+
+def filterOnePole(values, a, state):
+
+    ## Runs y[n] = a * y[n - 1] + (1 - a) * x[n] over a block at once. Within a
+    ## run of samples, y[n] = a^(n + 1) * y[-1] + (1 - a) * a^n * (the sum of
+    ## x[k] * a^-k for k up to n), which is a cumulative sum. Runs are kept short
+    ## enough that a^-n stays well within the range of a double. Returns the
+    ## filtered samples, and the state to pick up from with the next block.
+    if state is None:
+        state = values[0]
+
+    runLength = max(1, min(len(values), 4096, int(150 / -math.log10(a))))
+    powers = a ** numpy.arange(runLength + 1)
+    output = numpy.empty(len(values))
+
+    for start in range(0, len(values), runLength):
+        run = values[start:start + runLength]
+        count = len(run)
+        output[start:start + count] = powers[1:count + 1] * state + (1 - a) * powers[:count] * numpy.cumsum(run / powers[:count])
+        state = output[start + count - 1]
+
+    return output, state
+
+def poleFor(cutoff, sampleRate):
+
+    ## The feedback of a one-pole filter with this cutoff (kept below Nyquist)
+    return math.exp(-2 * math.pi * min(cutoff, 0.49 * sampleRate) / sampleRate)
+
+def processSamples(channel, samples):
+
+    ## Returns the processed samples of a chunk, scaled up to the channel's
+    ## extra bits. Settings can change under us, so read them once.
+    processing = channel["processing"]
+    average = channel["average"]
+    lowpass = channel["lowpass"]
+    highpass = channel["highpass"]
+    dcRemove = channel["dcRemove"]
+    scale = channel["sampleScale"]
+
+    if average == 1 and lowpass is None and highpass is None and not dcRemove:
+        if scale == 1:
+            return samples
+        return numpy.minimum(samples, 65535 // scale) * numpy.uint16(scale)
+
+    values = samples.astype(float)
+    if average > 1:
+        values = numpy.concatenate((processing["pending"], values))
+        whole = len(values) - len(values) % average
+        processing["pending"] = values[whole:]
+        values = values[:whole].reshape(-1, average).mean(axis = 1)
+
+    if len(values) == 0:
+        return numpy.zeros(0, dtype = numpy.uint16)
+
+    sampleRate = channel["timingRate"]
+    centre = channel["peak"] / scale / 2
+    if lowpass is not None:
+        values, processing["lowpass"] = filterOnePole(values, poleFor(lowpass, sampleRate), processing["lowpass"])
+    if highpass is not None:
+        smoothed, processing["highpass"] = filterOnePole(values, poleFor(highpass, sampleRate), processing["highpass"])
+        values = values - smoothed + centre
+    if dcRemove:
+        level, processing["dcRemove"] = filterOnePole(values, math.exp(-1 / (dcRemovalTime * sampleRate)), processing["dcRemove"])
+        values = values - level + centre
+
+    return numpy.clip(numpy.rint(values * scale), 0, 65535).astype(numpy.uint16)
+
+## Captures start with a header line and a JSON description of the channel,
+## padded to a fixed size. The samples follow in fixed-size blocks, each with a
+## record of its sequence number, the index of its first sample, and the time
+## that sample arrived. Raw files of two-byte samples with no header still work.
+captureMagic = b"NANOSCOPE CAPTURE 1\n"
+captureHeaderSize = 1024
+captureBlockSize = 4096
+captureRecordFormat = ">4sIQdI"
+
+def captureBlockType(blockSize):
+    return numpy.dtype([("marker", "S4"), ("sequence", ">u4"), ("sampleIndex", ">u8"), ("time", ">f8"), ("count", ">u4"),
+                        ("samples", ">u2", (blockSize,))])
+
+class BlockSamples:
+
+    ## The samples of a capture file with a header, which are split up by the
+    ## block records. This indexes them like a one-dimensional array without
+    ## copying anything out of the file. Slicing gives another view.
+    def __init__(self, blockSamples, start, length):
+        self.blockSamples = blockSamples
+        self.start = start
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            return BlockSamples(self.blockSamples, self.start + start, max(0, stop - start))
+
+        index = numpy.asarray(index) + self.start
+        blockSize = self.blockSamples.shape[1]
+        return self.blockSamples[index // blockSize, index % blockSize]
+
+    def __array__(self, dtype = None, copy = None):
+        return numpy.asarray(self[numpy.arange(self.length)], dtype = dtype)
+
+def readCaptureHeader(channel):
+
+    ## Returns the samples of a capture that has a header, and picks up the
+    ## channel settings that it was recorded with
+    dataMap = channel["dataMap"]
+    header = json.loads(dataMap[len(captureMagic):captureHeaderSize].decode().strip())
+    blockType = captureBlockType(header["blockSize"])
+    blockCount = (len(dataMap) - captureHeaderSize) // blockType.itemsize
+    if blockCount == 0:
+        raise Exception("No data in " + channel["input"])
+
+    blocks = numpy.frombuffer(dataMap, dtype = blockType, offset = captureHeaderSize, count = blockCount)
+
+    channel["peak"] = header["peak"]
+    channel["vref"] = header["vref"]
+    channel["startTime"] = header["startTime"]
+
+    ## The sample rate is only written once the capture is closed. If it wasn't,
+    ## work it out from the block records.
+    if header["sampleRate"]:
+        channel["sampleRate"] = header["sampleRate"]
+    elif blockCount > 2 and blocks["time"][-2] > blocks["time"][0]:
+        channel["sampleRate"] = float(blocks["sampleIndex"][-2] - blocks["sampleIndex"][0]) / (blocks["time"][-2] - blocks["time"][0])
+
+    ## Only the last block may be partly filled
+    sampleCount = (blockCount - 1) * header["blockSize"] + int(blocks["count"][-1])
+    return BlockSamples(blocks["samples"], 0, sampleCount)
+
+def openCaptureFile(channel):
+
+    ## Map the capture into memory rather than reading it, so that playback starts
+    ## instantly and only touches the parts of the file that we look at.
+    dataFile = open(channel["input"], "rb")
+    if os.fstat(dataFile.fileno()).st_size < 2:
+        raise Exception("No data in " + channel["input"])
+    channel["dataMap"] = mmap.mmap(dataFile.fileno(), 0, access = mmap.ACCESS_READ)
+
+    if channel["dataMap"][:len(captureMagic)] == captureMagic:
+        samples = readCaptureHeader(channel)
+
+    else:
+        ## Raw captures hold whole samples, but a raw dump of a serial port might start part
+        ## way through one. Use whichever byte alignment has fewer values out of range.
+        head = numpy.frombuffer(channel["dataMap"], dtype = numpy.uint8, count = min(65536, len(channel["dataMap"])))
+        outOfRange = [numpy.count_nonzero(numpy.frombuffer(head[alignment:len(head) - (len(head) - alignment) % 2], dtype = ">u2") > channel["peak"])
+                      for alignment in (0, 1)]
+        alignment = 0 if outOfRange[0] <= outOfRange[1] else 1
+
+        samples = numpy.frombuffer(channel["dataMap"], dtype = ">u2", offset = alignment, count = (len(channel["dataMap"]) - alignment) // 2)
+
+    playSamples(channel, samples)
+
+def playSamples(channel, samples):
+
+    ## Play back only the range they asked for. This is a view, so nothing
+    ## outside of it is ever read.
+    start = 0
+    end = len(samples)
+    if channel["start"] is not None:
+        start = max(0, min(len(samples) - 1, parseSamplePosition(channel["start"], channel["sampleRate"])))
+    if channel["end"] is not None:
+        end = max(start + 1, min(len(samples), parseSamplePosition(channel["end"], channel["sampleRate"])))
+
+    channel["dataBuffer"] = samples[start:end]
+    channel["dataIndex"] = 0
+    channel["playStart"] = start
+
+    ## Headless analysis reads straight through the file once, so it doesn't need
+    ## a pyramid. Let the OS know, so it reads ahead and drops pages behind us.
+    if args.headless:
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            channel["dataMap"].madvise(mmap.MADV_SEQUENTIAL)
+        return
+
+    ## The pyramid starts at blocks of 256 samples to keep its memory small next to
+    ## the capture, and is built in the background. Zoomed-out views are drawn
+    ## from a sparser sampling until it's ready.
+    channel["pyramid"] = createPyramid(len(channel["dataBuffer"]), 256)
+    channel["pyramidFilled"] = 0
+    threading.Thread(target = fillPyramid, args = (channel,), daemon = True).start()
+
+def fillPyramid(channel):
+    samples = channel["dataBuffer"]
+    chunkSize = 1024 * 1024
+
+    for start in range(0, len(samples), chunkSize):
+        count = min(chunkSize, len(samples) - start)
+        updatePyramid(channel["pyramid"], samples, start, count)
+        channel["pyramidFilled"] = start + count
+
+## WAV files (of a sound card recording, say) are played back from one of their
+## channels, which is recording.wav for the first and recording.wav#2 for the
+## second. Samples of 8 bits are used as they are. Larger integer samples are
+## read as their top 16 bits, straight out of the file, and floating point ones
+## are scaled to 16 bits. Either way, they're offset to be unsigned like the Nano's.
+class WaveSamples:
+
+    ## The samples of a WAV file, converted as they are read. Slicing gives
+    ## another view, so nothing outside of what's drawn is ever read. Floating
+    ## point samples are scaled by scale, and integer ones (with no scale) have
+    ## their sign bit flipped.
+    def __init__(self, samples, scale = None):
+        self.samples = samples
+        self.scale = scale
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return WaveSamples(self.samples[index], self.scale)
+
+        values = numpy.asarray(self.samples[index])
+        if self.scale is None:
+            return values.astype(numpy.uint16) ^ numpy.uint16(0x8000)
+
+        return numpy.clip(values * self.scale + 32768, 0, 65535).astype(numpy.uint16)
+
+    def __array__(self, dtype = None, copy = None):
+        return numpy.asarray(self[numpy.arange(len(self))], dtype = dtype)
+
+def openWaveFile(channel):
+    path, _, number = channel["input"].rpartition("#") if "#" in channel["input"] else (channel["input"], "", "")
+    dataFile = open(path, "rb")
+    channel["dataMap"] = mmap.mmap(dataFile.fileno(), 0, access = mmap.ACCESS_READ)
+    dataMap = channel["dataMap"]
+
+    if dataMap[0:4] != b"RIFF" or dataMap[8:12] != b"WAVE":
+        raise Exception(path + " isn't a WAV file")
+
+    ## Find the format and the samples among the file's chunks
+    position = 12
+    sampleFormat = None
+    while position + 8 <= len(dataMap):
+        chunkId, chunkSize = struct.unpack_from("<4sI", dataMap, position)
+        if chunkId == b"fmt ":
+            sampleFormat = struct.unpack_from("<HHIIHH", dataMap, position + 8)
+            if sampleFormat[0] == 0xFFFE:
+                sampleFormat = struct.unpack_from("<H", dataMap, position + 32) + sampleFormat[1:]
+        if chunkId == b"data":
+            break
+        position = position + 8 + chunkSize + chunkSize % 2
+
+    if sampleFormat is None or position + 8 > len(dataMap):
+        raise Exception("No data in " + path)
+
+    encoding, channelCount, sampleRate, _, frameSize, sampleBits = sampleFormat
+    dataOffset = position + 8
+    dataSize = min(chunkSize, len(dataMap) - dataOffset)
+    sampleBytes = sampleBits // 8
+
+    channelNumber = int(number) - 1 if number else 0
+    if not 0 <= channelNumber < channelCount:
+        raise Exception(path + " only has " + str(channelCount) + " channels")
+
+    ## The samples of one channel, as a strided view of the file
+    frameCount = dataSize // frameSize
+    start = dataOffset + channelNumber * sampleBytes
+    if encoding == 1 and sampleBits == 8:
+        samples = numpy.ndarray((frameCount,), dtype = numpy.uint8, buffer = dataMap, offset = start, strides = (frameSize,))
+        channel["peak"] = 256
+    elif encoding == 1 and sampleBits >= 16:
+        samples = WaveSamples(numpy.ndarray((frameCount,), dtype = "<i2", buffer = dataMap, offset = start + sampleBytes - 2, strides = (frameSize,)))
+        channel["peak"] = 65536
+    elif encoding == 3 and sampleBits == 32:
+        samples = WaveSamples(numpy.ndarray((frameCount,), dtype = "<f4", buffer = dataMap, offset = start, strides = (frameSize,)), 32768)
+        channel["peak"] = 65536
+    else:
+        raise Exception(path + " has samples that can't be played back (only PCM, or 32-bit floating point)")
+
+    if frameCount == 0:
+        raise Exception("No data in " + path)
+
+    channel["sampleRate"] = sampleRate
+    playSamples(channel, samples)
+
+def writeCaptureHeader(channel, sampleRate):
+    description = {
+        "input": channel["input"],
+        "peak": channel["peak"],
+        "vref": channel["vref"],
+        "invert": channel["invert"],
+        "offset": channel["offset"],
+        "scale": channel["scale"],
+        "zoom": channel["zoom"],
+        "sampleRate": sampleRate,
+        "startTime": channel["startTime"],
+        "blockSize": captureBlockSize
+    }
+
+    ## The header has to fit in front of the first block. Only the input can
+    ## make it too long, and it's never read back, so leave that out if it does.
+    header = json.dumps(description).encode()
+    if len(captureMagic + header) >= captureHeaderSize:
+        del description["input"]
+        header = json.dumps(description).encode()
+    if len(captureMagic + header) >= captureHeaderSize:
+        raise Exception("The capture header for " + channel["input"] + " is too long")
+
+    channel["captureFile"].seek(0)
+    channel["captureFile"].write((captureMagic + header).ljust(captureHeaderSize - 1) + b"\n")
+
+def writeCapture(channel):
+
+    ## Collect the samples into blocks and write them out on our own thread, so
+    ## that a slow disk never holds up acquisition or drawing. If the disk falls
+    ## that far behind, samples that don't fit in the queue are left out and
+    ## counted rather than waited for.
+    captureFile = channel["captureFile"]
+    blockSamples = numpy.zeros(captureBlockSize, dtype = ">u2")
+    blockFilled = 0
+    blockTime = 0
+    sequence = 0
+    sampleIndex = 0
+
+    firstTime = None
+    lastTime = None
+    firstCount = 0
+
+    while True:
+        item = channel["captureQueue"].get()
+        if item is None:
+            break
+
+        samples, arrivalTime = item
+        if firstTime is None:
+            firstTime = arrivalTime
+            firstCount = len(samples)
+        lastTime = arrivalTime
+
+        position = 0
+        while position < len(samples):
+            if blockFilled == 0:
+                blockTime = arrivalTime
+
+            count = min(captureBlockSize - blockFilled, len(samples) - position)
+            blockSamples[blockFilled:blockFilled + count] = samples[position:position + count]
+            blockFilled = blockFilled + count
+            position = position + count
+
+            if blockFilled == captureBlockSize:
+                captureFile.write(struct.pack(captureRecordFormat, b"NSBK", sequence, sampleIndex, blockTime, blockFilled))
+                captureFile.write(blockSamples.tobytes())
+                sequence = sequence + 1
+                sampleIndex = sampleIndex + blockFilled
+                blockFilled = 0
+
+    ## Pad out the last block, and then record the sample rate that we measured
+    if blockFilled > 0:
+        blockSamples[blockFilled:] = 0
+        captureFile.write(struct.pack(captureRecordFormat, b"NSBK", sequence, sampleIndex, blockTime, blockFilled))
+        captureFile.write(blockSamples.tobytes())
+        sampleIndex = sampleIndex + blockFilled
+
+    sampleRate = None
+    if not timedByArrival(channel):
+        sampleRate = channel["sampleRate"]
+    elif firstTime is not None and lastTime > firstTime:
+        sampleRate = (sampleIndex + channel["samplesNotCaptured"] - firstCount) / (lastTime - firstTime)
+
+    writeCaptureHeader(channel, sampleRate)
+    captureFile.close()
+
+def startCapture(channel):
+    channel["captureFile"] = open(channel["capture"], "wb", buffering = 1024 * 1024)
+    channel["captureQueue"] = queue.Queue(maxsize = 256)
+    channel["startTime"] = time.time()
+    writeCaptureHeader(channel, None)
+
+    channel["captureWriter"] = threading.Thread(target = writeCapture, args = (channel,), daemon = True)
+    channel["captureWriter"].start()
+
+def captureSamples(channel, samples):
+    if channel["captureQueue"] is not None:
         try:
-            channel["port"] = serial.Serial(channel["input"], channel["rate"])
+            channel["captureQueue"].put_nowait((samples, time.time()))
+        except queue.Full:
+            channel["samplesNotCaptured"] = channel["samplesNotCaptured"] + len(samples)
+
+def stopCapture(channel):
+    if channel["captureWriter"] is not None:
+        channel["captureQueue"].put(None)
+        channel["captureWriter"].join()
+        channel["captureWriter"] = None
+        channel["captureQueue"] = None
+
+        if channel["samplesNotCaptured"] > 0:
+            print(str(channel["samplesNotCaptured"]) + " samples from " + channel["input"] + " were left out of " + channel["capture"] +
+                  " because the disk couldn't keep up", file = sys.stderr)
+
+## Streaming. With --serve, every channel's samples are sent on to any number of
+## other nanoscopes and WebSocket clients as they are read. Each client has its
+## own bounded queue, filled from an asyncio loop on its own thread, so a slow
+## client never holds up acquisition: blocks that don't fit in its queue are left
+## out, and for every couple of seconds that it stays full, it's sent every other
+## sample, then every fourth and so on, and dropped if even that's too much.
+##
+## Clients say which kind they are first. A stream starts with a header line and
+## a JSON description of the channels, and carries a record for each block of
+## samples: which channel it's from, which samples it leaves out, the number of
+## its first sample, and when that arrived.
+streamMagic = b"NANOSCOPE STREAM 1\n"
+streamHello = b"NANOSCOPE\n"
+streamRecordFormat = ">4sHHQdI"
+streamRecordSize = struct.calcsize(streamRecordFormat)
+streamQueueSize = 64
+streamMaxStep = 64
+streamAdapt = 2.0
+streamBuffer = 16384
+websocketGuid = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+serveLoop = None
+serveClients = []
+
+def describeStream():
+    description = []
+    for channel in channels:
+        sampleRate = channel["sampleRate"]
+        if timedByArrival(channel):
+            timing = measureTiming(channel)
+            sampleRate = timing[0] if timing is not None else None
+
+        description.append({"input": channel["input"], "peak": channel["peak"], "vref": channel["vref"], "sampleRate": sampleRate})
+
+    return json.dumps({"channels": description})
+
+def websocketFrame(opcode, payload):
+    if len(payload) < 126:
+        header = struct.pack(">BB", 0x80 | opcode, len(payload))
+    elif len(payload) < 65536:
+        header = struct.pack(">BBH", 0x80 | opcode, 126, len(payload))
+    else:
+        header = struct.pack(">BBQ", 0x80 | opcode, 127, len(payload))
 
-        except Exception as e:
-            channel["port"] = None
+    return header + payload
 
-        if channel["port"] is None:
-            dataFile = open(channel["input"], "rb")
-            channel["dataBuffer"] = dataFile.read()
-            channel["dataIndex"] = 0
+def streamRecord(number, samples, sampleIndex, arrivalTime, step, websocket):
+    record = (struct.pack(streamRecordFormat, b"NSST", number, step, sampleIndex, arrivalTime, len(samples)) +
+              numpy.asarray(samples[::step], dtype = ">u2").tobytes())
 
-    if channel["capture"] is not None:
-        channel["captureFile"] = open(channel["capture"], "wb")
+    if websocket:
+        return websocketFrame(2, record)
+    return record
+
+async def serveClient(reader, writer):
+    client = {"queue": asyncio.Queue(maxsize = streamQueueSize), "step": 1, "stepChanged": time.monotonic(), "websocket": False,
+              "task": asyncio.current_task()}
+
+    try:
+        request = await asyncio.wait_for(reader.readline(), timeout = 5)
+
+        ## WebSocket clients get the description as a text message, and each
+        ## record as a binary one
+        if request.startswith(b"GET "):
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout = 5)
+                if line.strip() == b"":
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            if "sec-websocket-key" not in headers:
+                return
+
+            accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + websocketGuid).encode()).digest()).decode()
+            writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n" +
+                          "Sec-WebSocket-Accept: " + accept + "\r\n\r\n").encode())
+            writer.write(websocketFrame(1, describeStream().encode()))
+            client["websocket"] = True
+
+        elif request == streamHello:
+            writer.write(streamMagic + describeStream().encode() + b"\n")
 
-def getSamples():
+        else:
+            return
+
+        ## Keep what's buffered on the way to the client small, so that its queue
+        ## fills up when it falls behind rather than its data arriving later and later
+        writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, streamBuffer)
+        writer.transport.set_write_buffer_limits(streamBuffer)
+
+        serveClients.append(client)
+        while True:
+            writer.write(await client["queue"].get())
+            await writer.drain()
+
+    except (asyncio.TimeoutError, asyncio.CancelledError, ConnectionError):
+        pass
+
+    finally:
+        if client in serveClients:
+            serveClients.remove(client)
+        writer.close()
+
+def fanOut(number, samples, sampleIndex, arrivalTime):
+
+    ## Runs on the server's loop. Clients that are sent the same samples share
+    ## their records.
+    records = {}
+    now = time.monotonic()
+
+    for client in list(serveClients):
+        clientQueue = client["queue"]
+        adapt = now - client["stepChanged"] >= streamAdapt
+
+        if clientQueue.full():
+            if adapt:
+                client["step"] = client["step"] * 2
+                client["stepChanged"] = now
+                if client["step"] > streamMaxStep:
+                    serveClients.remove(client)
+                    client["task"].cancel()
+            continue
+
+        if clientQueue.empty() and client["step"] > 1 and adapt:
+            client["step"] = client["step"] // 2
+            client["stepChanged"] = now
+
+        recordType = (client["step"], client["websocket"])
+        if recordType not in records:
+            records[recordType] = streamRecord(number, samples, sampleIndex, arrivalTime, client["step"], client["websocket"])
+        clientQueue.put_nowait(records[recordType])
+
+def serveSamples(channel, samples, arrivalTime):
+    if serveLoop is None or len(samples) == 0:
+        return
+
+    number = next(n for n, other in enumerate(channels) if other is channel)
+    serveLoop.call_soon_threadsafe(fanOut, number, samples, channel["samplesServed"], arrivalTime)
+    channel["samplesServed"] = channel["samplesServed"] + len(samples)
+
+def startServing():
+    global serveLoop
+    if args.serve is None:
+        return
+
+    host, _, port = args.serve.rpartition(":")
+    serveLoop = asyncio.new_event_loop()
+    serveLoop.run_until_complete(asyncio.start_server(serveClient, host.strip("[]") or None, int(port)))
+    threading.Thread(target = serveLoop.run_forever, daemon = True).start()
+
+def openStream(channel):
+
+    ## Connect to another nanoscope's --serve, and pick up the settings of the
+    ## channel we're watching (tcp://host:port/2 for its second channel)
+    address, _, number = channel["input"][len("tcp://"):].partition("/")
+    host, _, port = address.rpartition(":")
+    connection = socket.create_connection((host.strip("[]"), int(port)), timeout = 5)
+    connection.sendall(streamHello)
+
+    header = b""
+    while header.count(b"\n") < 2:
+        data = connection.recv(4096)
+        if len(data) == 0:
+            raise Exception("No stream from " + channel["input"])
+        header = header + data
+
+    magic, description, rest = header.split(b"\n", 2)
+    if magic + b"\n" != streamMagic:
+        raise Exception("No stream from " + channel["input"])
+
+    description = json.loads(description)["channels"]
+    channel["streamChannel"] = int(number) - 1 if number else 0
+    if not 0 <= channel["streamChannel"] < len(description):
+        raise Exception(channel["input"] + " only has " + str(len(description)) + " channels")
+
+    settings = description[channel["streamChannel"]]
+    channel["peak"] = settings["peak"]
+    channel["vref"] = settings["vref"]
+    if settings["sampleRate"]:
+        channel["sampleRate"] = settings["sampleRate"]
+
+    connection.settimeout(0.1)
+    channel["port"] = connection
+    channel["protocol"] = "stream"
+    channel["streamPending"] = bytearray(rest)
+
+## Long histories are kept in a temporary file (in TMPDIR) that's mapped into
+## memory as the ring buffer, so that everything that works on the ring works on
+## all of it. The OS keeps the recently written parts in memory and writes the
+## rest out to disk in the background. The file's space is allocated up front,
+## so that the reader threads never wait for the disk to find room.
+historyBlock = 1024
+
+def openHistory(channel):
+    sampleCount = parseBufferSize(args.history, channel["sampleRate"])
+    channel["historyFile"] = tempfile.TemporaryFile(prefix = "nanoscope-")
+
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(channel["historyFile"].fileno(), 0, sampleCount * 2)
+    else:
+        channel["historyFile"].truncate(sampleCount * 2)
+
+    channel["dataBuffer"] = numpy.memmap(channel["historyFile"], dtype = numpy.uint16, mode = "r+", shape = (sampleCount,))
+
+def indexTimes(channel, count, arrivalTime):
+
+    ## Note when the last count samples written to the ring arrived, for each
+    ## block of the ring that they're in
+    blockTimes = channel["blockTimes"]
+    count = min(count, len(channel["dataBuffer"]))
+    end = channel["writeIndex"] if channel["writeIndex"] > 0 else len(channel["dataBuffer"])
 
-    samples = [getSample(channels[0]), getSample(channels[1])]
-    return samples
+    firstBlock = (end - count) // historyBlock
+    lastBlock = (end - 1) // historyBlock
+    blockTimes[numpy.arange(firstBlock, lastBlock + 1) % len(blockTimes)] = arrivalTime
 
-def getSample(channel):
+def indexTime(channel, index):
 
-    if channel["input"] is None:
+    ## When the samples at a place in the ring buffer arrived, to within a block
+    return channel["blockTimes"][(index % len(channel["dataBuffer"])) // historyBlock]
+
+def oldestIndex(channel):
+
+    ## Where the oldest sample we still have is in the ring buffer
+    if channel["port"] is None:
         return 0
 
-    try:
-        ## Read an integer as two bytes, big-endian
-        if (channel["port"] is not None) and (channel["triggerIndex"] < 0):
+    with channel["dataReady"]:
+        return (channel["writeIndex"] - channel["samplesFilled"]) % len(channel["dataBuffer"])
+
+## Inputs. Each kind of input says whether it's the one given, and opens it.
+## Serial ports and pipes are read a chunk at a time on their own threads and
+## decoded into the ring buffer. Captures and WAV files are mapped into memory
+## and played back from there. Every input reports its own sample rate where it
+## knows it, and otherwise uses --samplerate.
+def readPortBytes(port, limit):
+
+    ## Take everything the port has (up to limit bytes) in one read, or wait (up to
+    ## its timeout) for the next byte. Returns the data, and whether it was already waiting.
+    waiting = port.in_waiting
+    return port.read(max(1, waiting if limit is None else min(waiting, limit))), waiting > 0
+
+def readPipeBytes(pipe, limit):
+
+    ## Take whatever the pipe has. Like a port, wait up to a tenth of a second
+    ## for it if there's nothing yet (where pipes can be waited on).
+    waiting = os.name != "nt" and len(select.select([pipe], [], [], 0)[0]) > 0
+    if os.name != "nt" and not waiting and len(select.select([pipe], [], [], 0.1)[0]) == 0:
+        return b"", False
+
+    data = os.read(pipe.fileno(), 1 << 16 if limit is None else limit)
+    if len(data) == 0:
+        raise EOFError()
+
+    return data, waiting
+
+def openSerialPort(channel):
+    if channel["rate"] is None:
+        raise Exception("Specify a serial rate for " + channel["input"])
+
+    channel["port"] = serial.Serial(channel["input"], channel["rate"], timeout = 0.1)
+    channel["readBytes"] = readPortBytes
+
+def openPipe(channel):
+
+    ## Samples piped in are sent the same way as a serial port sends them
+    channel["port"] = sys.stdin.buffer
+    channel["readBytes"] = readPipeBytes
 
-            inputHigh, inputLow = channel["port"].read(2)
-            channel["sampleTotal"] = channel["sampleTotal"] + 2
+    ## Unlike a serial port, a pipe can wait for us, so headless analysis gets
+    ## to measure every sample rather than skipping the ones it falls behind on
+    channel["waitsForAnalysis"] = args.headless
 
-            ## If this data point is out of range, we've had a sync error
-            ## so read in another byte.
-            while ((inputHigh << 8) | inputLow) > channel["peak"]:
-                inputHigh = inputLow
-                inputLow = channel["port"].read(1)[0]
-                channel["sampleTotal"] = channel["sampleTotal"] + 1
+def isFile(name):
+    return os.path.isfile(name.rpartition("#")[0] if "#" in name else name)
 
-            channel["dataBuffer"][channel["dataIndex"]] = inputHigh
-            channel["dataIndex"] = (channel["dataIndex"] + 1) % len(channel["dataBuffer"])
-            channel["dataBuffer"][channel["dataIndex"]] = inputLow
-            channel["dataIndex"] = (channel["dataIndex"] + 1) % len(channel["dataBuffer"])
+inputSources = {
+    "stream": (lambda name: name.lower().startswith("tcp://"), openStream),
+    "pipe": (lambda name: name == "-", openPipe),
+    "wav": (lambda name: name.lower().partition("#")[0].endswith(".wav") and isFile(name), openWaveFile),
+    "capture": (os.path.isfile, openCaptureFile),
+    "serial": (lambda name: True, openSerialPort)
+}
 
+def openInput(channel):
+    for source, (matches, openSource) in inputSources.items():
+        if matches(channel["input"]):
+            openSource(channel)
+            channel["source"] = source
+            break
+
+    channel["timingRate"] = channel["sampleRate"]
+
+def timedByArrival(channel):
+
+    ## Serial ports and streams arrive as they're sampled, so their sample rate
+    ## is measured from when their data arrives. A pipe can be read far faster
+    ## than it was sampled, so it keeps to --samplerate like a file.
+    return channel["source"] in ("serial", "stream")
+
+for channel in channels:
+    openInput(channel)
+    if channel["port"] is not None:
+        startProcessing(channel)
+    elif (channel["requestedAverage"] != 1 or channel["lowpassCutoff"] is not None or channel["highpassCutoff"] is not None or
+          channel["requestedDcRemove"]):
+        channel["processingIgnored"] = True
+        print("Only live inputs are averaged and filtered, so " + channel["input"] + " is played back as it was recorded", file = sys.stderr)
+
+    if channel["port"] is not None and args.history is not None:
+        openHistory(channel)
+
+    ## Serial ports note when every block of their ring buffer was last written
+    if channel["port"] is not None:
+        channel["blockTimes"] = numpy.full(-(-len(channel["dataBuffer"]) // historyBlock), numpy.nan)
+
+    ## The pyramid over a long history starts at larger blocks, like a capture's
+    if channel["pyramid"] is None and channel["dataMap"] is None:
+        channel["pyramid"] = createPyramid(len(channel["dataBuffer"]), 256 if channel["historyFile"] is not None else 4)
+        channel["pyramidFilled"] = len(channel["dataBuffer"])
+
+    ## Adjust trigger if they specified something in volts. Do this once the input
+    ## is open, since a capture file may say what its vref is.
+    if channel["trigger"] < 10:
+        channel["trigger"] = channel["trigger"] / channel["vref"] * channel["peak"]
+    else:
+        channel["trigger"] = channel["trigger"] * channel["sampleScale"]
+    channel["originalTrigger"] = channel["trigger"]
+
+    if channel["capture"] is not None:
+        startCapture(channel)
+
+## Instrumentation. Each stage of getting samples onto the screen records how
+## long it takes into a histogram, and the channels count what they receive and
+## lose. Recording is cheap enough to always be on.
+metricsStages = ["read", "decode", "process", "trigger", "geometry", "draw", "frame"]
+metricsBuckets = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, math.inf]
+metricsRecent = 256
+metricsInterval = 1.0
+metricsLock = threading.Lock()
+
+metrics = {stage: {"count": 0, "sum": 0.0, "buckets": [0] * len(metricsBuckets), "recent": numpy.zeros(metricsRecent)}
+           for stage in metricsStages}
+
+def recordTime(stage, seconds):
+    with metricsLock:
+        timings = metrics[stage]
+        timings["recent"][timings["count"] % metricsRecent] = seconds
+        timings["count"] = timings["count"] + 1
+        timings["sum"] = timings["sum"] + seconds
+
+        for index, bound in enumerate(metricsBuckets):
+            if seconds <= bound:
+                timings["buckets"][index] = timings["buckets"][index] + 1
+                break
+
+def metricsSnapshot():
+
+    ## Everything so far, with the bucket counts cumulative as Prometheus has them.
+    ## Ports report the sample rate they really run at, once it's been measured.
+    stages = {}
+    with metricsLock:
+        for stage, timings in metrics.items():
+            recent = timings["recent"][:min(timings["count"], metricsRecent)]
+            stages[stage] = {
+                "count": timings["count"],
+                "sum": timings["sum"],
+                "buckets": [int(count) for count in numpy.cumsum(timings["buckets"])],
+                "recentMedian": float(numpy.median(recent)) if len(recent) > 0 else None,
+                "recentP99": float(numpy.percentile(recent, 99)) if len(recent) > 0 else None
+            }
+
+    channelMetrics = []
+    for channel in channels:
+        sampleRate = channel["sampleRate"]
+        if timedByArrival(channel):
+            timing = measureTiming(channel)
+            sampleRate = timing[0] if timing is not None else None
+
+        channelMetrics.append({
+            "input": channel["input"],
+            "protocol": channel["protocol"],
+            "sampleRate": sampleRate,
+            "samplesRead": channel["samplesRead"],
+            "bytesReceived": channel["sampleTotal"],
+            "bytesSkipped": channel["bytesSkipped"],
+            "bytesDiscarded": channel["bytesDiscarded"],
+            "samplesDiscarded": channel["samplesDiscarded"],
+            "framesDropped": channel["framing"]["dropped"],
+            "framesCorrupt": channel["framing"]["corrupt"],
+            "samplesMissing": channel["samplesMissing"],
+            "samplesNotCaptured": channel["samplesNotCaptured"]
+        })
+
+    return {"time": time.time(), "stages": stages, "channels": channelMetrics}
+
+def prometheusMetrics():
+
+    ## The snapshot in Prometheus' text format
+    snapshot = metricsSnapshot()
+    lines = ["# TYPE nanoscope_stage_seconds histogram"]
+
+    for stage, timings in snapshot["stages"].items():
+        for bound, count in zip(metricsBuckets, timings["buckets"]):
+            lines.append('nanoscope_stage_seconds_bucket{stage="' + stage + '",le="' + ("+Inf" if bound == math.inf else repr(bound)) + '"} ' + str(count))
+        lines.append('nanoscope_stage_seconds_sum{stage="' + stage + '"} ' + repr(float(timings["sum"])))
+        lines.append('nanoscope_stage_seconds_count{stage="' + stage + '"} ' + str(timings["count"]))
+
+    counters = [("samplesRead", "nanoscope_samples_read_total", "counter"),
+                ("bytesReceived", "nanoscope_bytes_received_total", "counter"),
+                ("bytesSkipped", "nanoscope_bytes_skipped_total", "counter"),
+                ("bytesDiscarded", "nanoscope_bytes_discarded_total", "counter"),
+                ("samplesDiscarded", "nanoscope_samples_discarded_total", "counter"),
+                ("framesDropped", "nanoscope_frames_dropped_total", "counter"),
+                ("framesCorrupt", "nanoscope_frames_corrupt_total", "counter"),
+                ("samplesMissing", "nanoscope_samples_missing_total", "counter"),
+                ("samplesNotCaptured", "nanoscope_samples_not_captured_total", "counter"),
+                ("sampleRate", "nanoscope_sample_rate_hertz", "gauge")]
+
+    for field, name, kind in counters:
+        lines.append("# TYPE " + name + " " + kind)
+        for channel in snapshot["channels"]:
+            if channel[field] is not None:
+                lines.append(name + '{channel="' + channel["input"].replace('\\', '\\\\').replace('"', '\\"') + '"} ' +
+                             (repr(float(channel[field])) if kind == "gauge" else str(int(channel[field]))))
+
+    return "\n".join(lines) + "\n"
+
+def describeMetrics(snapshot):
+
+    ## The snapshot as a few lines of text for the overlay
+    lines = []
+    for stage, timings in snapshot["stages"].items():
+        if timings["recentMedian"] is not None:
+            lines.append(format(stage, "<9") + format(timings["recentMedian"] * 1000, "7.2f") + " ms median, " +
+                         format(timings["recentP99"] * 1000, "7.2f") + " ms p99")
+
+    for channel in snapshot["channels"]:
+        rate = "?" if channel["sampleRate"] is None else format(channel["sampleRate"], ".0f")
+        lines.append(channel["input"] + ": " + rate + " samples/s, " + str(channel["bytesReceived"]) + " bytes, " +
+                     str(channel["bytesSkipped"]) + " resynced, " + str(channel["bytesDiscarded"]) + " bytes and " +
+                     str(channel["samplesDiscarded"]) + " samples discarded, " + str(channel["framesDropped"]) + "/" +
+                     str(channel["framesCorrupt"]) + " frames dropped/corrupt" +
+                     (", " + str(channel["samplesNotCaptured"]) + " not captured" if channel["samplesNotCaptured"] > 0 else ""))
+
+    return "\n".join(lines)
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = prometheusMetrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def writeMetrics():
+    while True:
+        time.sleep(metricsInterval)
+        with open(args.metrics, "a") as metricsFile:
+            metricsFile.write(json.dumps(metricsSnapshot()) + "\n")
+
+def startMetrics():
+    if args.metrics is not None:
+        threading.Thread(target = writeMetrics, daemon = True).start()
+
+    if args.metricsport is not None:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", args.metricsport), MetricsHandler)
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+
+def readSerial(channel):
+
+    ## Drain the port in large chunks, decode them, and put the samples into the
+    ## channel's ring buffer. This runs on its own thread so that no samples are
+    ## lost while a frame is being drawn.
+    port = channel["port"]
+    pendingData = b""
+
+    while channel["reading"]:
+        ## If analysis has to see every sample, wait until it's measured all but
+        ## half a ring buffer's worth before reading more. There's never more
+        ## than a sample to a byte, so a quarter buffer's worth of bytes (and
+        ## whatever's pending) still fits in the rest.
+        readLimit = None
+        if channel["waitsForAnalysis"]:
+            readLimit = len(channel["dataBuffer"]) // 4
+            with channel["dataReady"]:
+                if not channel["dataReady"].wait_for(lambda: channel["samplesRead"] - channel["dataIndex"] <= len(channel["dataBuffer"]) // 2,
+                                                     timeout = 0.5):
+                    continue
+
+        ## Only reads of data that was already waiting are timed, since the
+        ## others spend most of their time waiting for it to arrive
+        readBegin = time.perf_counter()
+        try:
+            data, waiting = channel["readBytes"](port, readLimit)
+        except EOFError:
+            break
+        except Exception as e:
+            print(e, file = sys.stderr)
+            break
+
+        if len(data) == 0:
+            continue
+
+        arrivalTime = time.time()
+        if waiting:
+            recordTime("read", time.perf_counter() - readBegin)
+        channel["sampleTotal"] = channel["sampleTotal"] + len(data)
+
+        ## If we're paused (navigating or after a one shot trigger), keep the
+        ## port drained but leave the captured data alone. The samples we drop
+        ## throw off the timing, so start measuring it again afterwards. Samples
+        ## are still decoded for anyone we're serving them to.
+        if channel["triggerIndex"] >= 0 and serveLoop is None:
+            channel["bytesDiscarded"] = channel["bytesDiscarded"] + len(pendingData) + len(data)
+            pendingData = b""
+            channel["arrivalCount"] = 0
+            channel["framing"]["sequence"] = None
+            continue
+
+        ## Hang on to any partial sample (or frame) until the next read. Until
+        ## we know how the port is sending its samples, hang on to everything.
+        data = pendingData + data
+        if channel["protocol"] == "auto":
+            if len(data) < protocolDetectBytes:
+                pendingData = data
+                continue
+            channel["protocol"] = detectProtocol(data)
+
+        decodeBegin = time.perf_counter()
+        if channel["protocol"] == "framed":
+            samples, consumed = decodeFrames(data, channel["framing"])
         else:
-            inputHigh = channel["dataBuffer"][channel["dataIndex"]]
-            channel["dataIndex"] = (channel["dataIndex"] + 1) % len(channel["dataBuffer"])
-            inputLow = channel["dataBuffer"][channel["dataIndex"]]
-            channel["dataIndex"] = (channel["dataIndex"] + 1) % len(channel["dataBuffer"])
+            samples, consumed, skipped = decodeSamples(data, channel["inputPeak"])
+            channel["bytesSkipped"] = channel["bytesSkipped"] + skipped
+        recordTime("decode", time.perf_counter() - decodeBegin)
+
+        processBegin = time.perf_counter()
+        samples = processSamples(channel, samples)
+        recordTime("process", time.perf_counter() - processBegin)
+
+        pendingData = data[consumed:]
+        serveSamples(channel, samples, arrivalTime)
+        keepSamples(channel, samples, arrivalTime)
+
+    endInput(channel)
+
+def endInput(channel):
+
+    ## Let anyone waiting for more samples know that there won't be any
+    with channel["dataReady"]:
+        channel["inputEnded"] = True
+        channel["dataReady"].notify_all()
+
+def keepSamples(channel, samples, arrivalTime):
+
+    ## Capture a port's samples and add them to its ring buffer, unless we're paused
+    if channel["triggerIndex"] >= 0:
+        channel["samplesDiscarded"] = channel["samplesDiscarded"] + len(samples)
+        channel["arrivalCount"] = 0
+        return
+
+    captureSamples(channel, samples)
+
+    with channel["dataReady"]:
+        measureSamples(channel, samples, channel["samplesRead"])
+        appendSamples(channel, samples)
+        indexTimes(channel, len(samples), arrivalTime)
+
+        ## Remember how many samples we'd had by the time each read arrived
+        arrivals = channel["arrivals"]
+        arrivals[channel["arrivalCount"] % len(arrivals)] = (channel["samplesRead"], arrivalTime)
+        channel["arrivalCount"] = channel["arrivalCount"] + 1
+
+def readStream(channel):
+
+    ## Take the records that another nanoscope serves for our channel and keep
+    ## their samples. Samples it left out are filled in with the last one before
+    ## them, so that everything after them stays in its place in time. Times
+    ## are when the samples arrived at the server.
+    connection = channel["port"]
+    pendingData = channel["streamPending"]
+    lastValue = 0
+
+    while channel["reading"]:
+        recordSize = None
+        if len(pendingData) >= streamRecordSize:
+            marker, number, step, sampleIndex, arrivalTime, count = struct.unpack_from(streamRecordFormat, pendingData)
+            if marker != b"NSST":
+                print("Lost the stream from " + channel["input"], file = sys.stderr)
+                break
+            recordSize = streamRecordSize + 2 * -(-count // step)
+
+        if recordSize is None or len(pendingData) < recordSize:
+            readBegin = time.perf_counter()
+            try:
+                data = connection.recv(1 << 16)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                print(e, file = sys.stderr)
+                break
+
+            if len(data) == 0:
+                print(channel["input"] + " stopped serving", file = sys.stderr)
+                break
+
+            recordTime("read", time.perf_counter() - readBegin)
+            channel["sampleTotal"] = channel["sampleTotal"] + len(data)
+            pendingData.extend(data)
+            continue
+
+        values = numpy.frombuffer(pendingData, dtype = ">u2", count = -(-count // step), offset = streamRecordSize).astype(numpy.uint16)
+        del pendingData[:recordSize]
+        if number != channel["streamChannel"]:
+            continue
+
+        samples = numpy.repeat(values, step)[:count]
+        if channel["streamNext"] is not None and sampleIndex > channel["streamNext"]:
+            missing = sampleIndex - channel["streamNext"]
+            channel["samplesMissing"] = channel["samplesMissing"] + missing
+            samples = numpy.concatenate((numpy.full(min(missing, len(channel["dataBuffer"])), lastValue, dtype = numpy.uint16), samples))
+
+        channel["streamNext"] = sampleIndex + count
+        lastValue = samples[-1]
+
+        processBegin = time.perf_counter()
+        samples = processSamples(channel, samples)
+        recordTime("process", time.perf_counter() - processBegin)
+
+        serveSamples(channel, samples, arrivalTime)
+        keepSamples(channel, samples, arrivalTime)
+
+    endInput(channel)
+
+def appendSamples(channel, samples):
+
+    ## Add a chunk of decoded samples to the ring buffer with (at most) two
+    ## slice copies, however large it is, and wake anyone waiting for them
+    dataBuffer = channel["dataBuffer"]
+    bufferSize = len(dataBuffer)
+
+    ## Only the most recent buffer's worth of a large chunk can be kept
+    count = len(samples)
+    samples = samples[-bufferSize:]
+
+    with channel["dataReady"]:
+        writeIndex = (channel["writeIndex"] + count - len(samples)) % bufferSize
+        firstPart = min(len(samples), bufferSize - writeIndex)
+        dataBuffer[writeIndex:writeIndex + firstPart] = samples[:firstPart]
+        dataBuffer[0:len(samples) - firstPart] = samples[firstPart:]
+        channel["writeIndex"] = (writeIndex + len(samples)) % bufferSize
+        channel["samplesFilled"] = min(bufferSize, channel["samplesFilled"] + len(samples))
+        channel["samplesRead"] = channel["samplesRead"] + count
+        channel["samplesDiscarded"] = channel["samplesDiscarded"] + count - len(samples)
+
+        updatePyramid(channel["pyramid"], dataBuffer, writeIndex, firstPart)
+        updatePyramid(channel["pyramid"], dataBuffer, 0, len(samples) - firstPart)
+
+        channel["samplesWaiting"] = min(bufferSize, channel["samplesWaiting"] + len(samples))
+        channel["dataReady"].notify_all()
+
+def startReader(channel):
+    channel["reading"] = True
+    channel["reader"] = threading.Thread(target = readStream if channel["protocol"] == "stream" else readSerial, args = (channel,), daemon = True)
+    channel["reader"].start()
+
+def stopReader(channel):
+    channel["reading"] = False
+    if channel["reader"] is not None:
+        channel["reader"].join()
+        channel["reader"] = None
+
+def latestSamples(channel):
+
+    ## Take whatever the reader thread has buffered since the last frame. Returns
+    ## where the newest samples end in the ring buffer, how many samples we've
+    ## read in total, and how many the ring holds.
+    with channel["dataReady"]:
+        channel["samplesNew"] = channel["samplesWaiting"]
+        channel["samplesWaiting"] = 0
+
+        return channel["writeIndex"], channel["samplesRead"], channel["samplesFilled"]
+
+def viewSamples(channel, start, count):
+
+    ## Get count raw samples from start in the data buffer. Unless they wrap
+    ## around the end of the ring, this is a view rather than a copy.
+    dataBuffer = channel["dataBuffer"]
+    start = start % len(dataBuffer)
+
+    if start + count <= len(dataBuffer):
+        return numpy.asarray(dataBuffer[start:start + count])
+    if count <= len(dataBuffer):
+        return numpy.concatenate((numpy.asarray(dataBuffer[start:]), numpy.asarray(dataBuffer[:start + count - len(dataBuffer)])))
+
+    return numpy.asarray(dataBuffer[(start + numpy.arange(count)) % len(dataBuffer)])
+
+def getSpan(channel, start, count):
 
-            ## If this data point is out of range, we've had a sync error
-            ## so read in another byte.
-            while ((inputHigh << 8) | inputLow) > channel["peak"]:
-                inputHigh = inputLow
-                inputLow = channel["dataBuffer"][channel["dataIndex"]]
-                channel["dataIndex"] = (channel["dataIndex"] + 1) % len(channel["dataBuffer"])
+    ## Get count samples from start in the data buffer, as they should be displayed
+    values = viewSamples(channel, start, count).astype(float)
 
-        inputData = (inputHigh << 8) | (inputLow)
+    if channel["invert"]:
+        values = channel["peak"] - values
 
-        if channel["captureFile"] is not None:
-            channel["captureFile"].write(inputData.to_bytes(2, 'big'))
+    return values
 
-        if channel["invert"]:
-            return channel["peak"] - inputData
+def getTrace(channel, start, count, columns):
+
+    ## Get the points to draw for count samples from start, spread over the given
+    ## number of columns. If there's more than one sample per column, use the
+    ## min/max pyramid so that we draw each column's full range in constant time.
+    if count <= columns:
+        return numpy.arange(count), getSpan(channel, start, count)
+
+    if channel["pyramidFilled"] >= len(channel["dataBuffer"]):
+        mins, maxs = queryPyramid(channel["pyramid"], channel["dataBuffer"], start, count, columns)
+    else:
+        ## The pyramid for a capture file is still being built, so look at a
+        ## limited number of samples per column in the meantime
+        stride = max(1, count // (columns * 64))
+        indices = (start + numpy.arange(0, count, stride)) % len(channel["dataBuffer"])
+        columnStarts = (numpy.arange(columns) * len(indices)) // columns
+        mins = numpy.minimum.reduceat(channel["dataBuffer"][indices], columnStarts)
+        maxs = numpy.maximum.reduceat(channel["dataBuffer"][indices], columnStarts)
+
+    ## Zig-zag between each column's min and max, so that the line from one
+    ## column to the next starts where the last one ended
+    values = numpy.empty(2 * columns)
+    values[0::4] = mins[0::2]
+    values[1::4] = maxs[0::2]
+    values[2::4] = maxs[1::2]
+    values[3::4] = mins[1::2]
+
+    if channel["invert"]:
+        values = channel["peak"] - values
+
+    return numpy.repeat(numpy.arange(columns) * (count / columns), 2), values
+
+## How far back (or ahead, when playing back a file) to look for a trigger
+triggerSearch = 100000
+triggerLead = 1000
+
+def ringIndex(channel, sampleNumber):
+
+    ## Find where a sample, counting from the first one we read, is in the ring buffer
+    if channel["port"] is None:
+        return sampleNumber % len(channel["dataBuffer"])
+
+    with channel["dataReady"]:
+        return (channel["writeIndex"] - (channel["samplesRead"] - sampleNumber)) % len(channel["dataBuffer"])
+
+def findTriggers(values, level, hysteresis, rising):
+
+    ## Find every sample where the signal crosses the trigger level, all at once.
+    ## For a rising edge, the signal has to have dropped below the level (less the
+    ## hysteresis) since it last crossed, so that noise around the level doesn't
+    ## trigger again. A falling edge is the same thing upside down.
+    if not rising:
+        values = -values
+        level = -level
+
+    state = numpy.zeros(len(values), dtype = numpy.int8)
+    state[values < level - hysteresis] = 1
+    state[values >= level] = 2
+
+    ## Samples in between the two thresholds keep the state of the last one that wasn't
+    lastChange = numpy.where(state > 0, numpy.arange(len(values)), 0)
+    numpy.maximum.accumulate(lastChange, out = lastChange)
+    state = state[lastChange]
+
+    return numpy.flatnonzero((state[1:] == 2) & (state[:-1] == 1)) + 1
+
+def pickTrigger(positions, lastTrigger, holdoff, latest):
+
+    ## Choose which trigger to show: the latest one for live data, or the next one
+    ## when playing back. Once we've triggered, we can't trigger again until the
+    ## holdoff has passed, so follow that chain on from the last trigger.
+    if len(positions) == 0:
+        return None
+
+    if holdoff <= 0 or lastTrigger is None or lastTrigger > positions[-1]:
+        if latest:
+            return int(positions[-1])
+        return int(positions[0])
+
+    nextTrigger = numpy.searchsorted(positions, lastTrigger + holdoff)
+    if nextTrigger == len(positions):
+        ## Keep showing the last trigger until the holdoff has passed
+        lastIndex = numpy.searchsorted(positions, lastTrigger)
+        if lastIndex < len(positions) and positions[lastIndex] == lastTrigger:
+            return lastTrigger
+        return None
+
+    trigger = int(positions[nextTrigger])
+    while latest:
+        nextTrigger = numpy.searchsorted(positions, trigger + holdoff)
+        if nextTrigger == len(positions):
+            break
+        trigger = int(positions[nextTrigger])
+
+    return trigger
+
+## How many samples to search at a time when looking through the history
+seekChunk = 1 << 20
+
+def seekTrigger(channel, start, forward):
+
+    ## Find the next (or previous) trigger after the view starting at start in
+    ## the ring buffer, searching everything we still have a chunk at a time.
+    ## Returns how far to move the view to put it at the pre-trigger point, or
+    ## None if there isn't one.
+    with channel["dataReady"]:
+        filled = channel["samplesFilled"] if channel["port"] is not None else len(channel["dataBuffer"])
+
+    oldest = oldestIndex(channel)
+    preTrigger = int(channel["frameCount"] * min(100, max(0, args.pretrigger)) / 100)
+    current = (start - oldest) % len(channel["dataBuffer"]) + preTrigger
+    hysteresis = args.hysteresis / channel["vref"] * channel["peak"]
+
+    ## Step through the chunks from the view outwards. Each is searched from a
+    ## little earlier, so that the hysteresis can arm.
+    lo, hi = (current + 1, current + 1) if forward else (current, current)
+    while (hi < filled) if forward else (lo > 0):
+        if forward:
+            lo, hi = hi, min(filled, hi + seekChunk)
+        else:
+            lo, hi = max(0, lo - seekChunk), lo
+
+        lead = min(lo, triggerLead)
+        values = getSpan(channel, oldest + lo - lead, hi - lo + lead)
+        crossings = lo - lead + findTriggers(values, channel["trigger"], hysteresis, triggerEdge == "rising")
+        crossings = crossings[crossings >= lo]
+
+        if len(crossings) > 0:
+            return int((crossings[0] if forward else crossings[-1]) - current)
+
+    return None
+
+def estimateTiming(channel):
+
+    ## Each read recorded how many samples we'd had by the time it arrived. Every
+    ## delay on the way to us only makes data arrive later, so the reads that were
+    ## delayed least are the best guide to when samples were really taken. The
+    ## least delayed reads in each half give the port's real sample rate, and the
+    ## least delayed recent one tells us when its latest samples were taken.
+    ## Returns whether we know yet.
+    timing = measureTiming(channel)
+    if timing is None:
+        return False
+
+    channel["timingRate"], channel["timingSample"], channel["timingStart"] = timing
+    return True
+
+def measureTiming(channel):
+
+    ## Returns the port's sample rate, its latest sample, and when that was
+    ## taken, or None if there aren't enough reads to tell yet
+    with channel["dataReady"]:
+        arrivals = channel["arrivals"][:min(channel["arrivalCount"], len(channel["arrivals"]))].copy()
+
+    if len(arrivals) < 64 or arrivals[:, 1].max() - arrivals[:, 1].min() < 1:
+        return None
+
+    arrivals = arrivals[numpy.argsort(arrivals[:, 1])]
+    samples = arrivals[:, 0]
+    times = arrivals[:, 1] - arrivals[0, 1]
+
+    rate = numpy.polyfit(times, samples, 1)[0]
+    if rate <= 0:
+        return None
+
+    delays = times - samples / rate
+    half = len(arrivals) // 2
+    first = numpy.argmin(delays[:half])
+    second = half + numpy.argmin(delays[half:])
+    rate = (samples[second] - samples[first]) / (times[second] - times[first])
+
+    recent = arrivals[:, 1] >= arrivals[-1, 1] - timingRecent
+    return rate, samples[-1], numpy.min(arrivals[recent, 1] - (samples[recent] - samples[-1]) / rate)
+
+def sampleTime(channel, sampleNumber):
+    return channel["timingStart"] + channel["timingCorrection"] + (sampleNumber - channel["timingSample"]) / channel["timingRate"]
+
+def sampleAt(channel, when):
+    return (when - channel["timingStart"] - channel["timingCorrection"]) * channel["timingRate"] + channel["timingSample"]
+
+## How far back to look for the least delayed read
+timingRecent = 0.5
+
+## How often to cross-correlate, and how far either way to look for a match
+correlationInterval = 1.0
+correlationLength = 4096
+correlationLag = 256
+lastCorrelation = 0
+
+def alignByCorrelation(reference, channel):
+
+    ## Refine a port's timing by cross-correlating a test signal that it and the
+    ## reference are both measuring. The correlation peaks at whatever offset the
+    ## timestamps left between them, which we find to a fraction of a sample.
+    with reference["dataReady"]:
+        referenceRead, referenceFilled = reference["samplesRead"], reference["samplesFilled"]
+    with channel["dataReady"]:
+        channelRead, channelFilled = channel["samplesRead"], channel["samplesFilled"]
+
+    ## Take the latest stretch that both of them have, with the port's samples
+    ## resampled onto the reference's timebase
+    referenceEnd = min(referenceRead, int(sampleAt(reference, sampleTime(channel, channelRead)))) - correlationLag - 1
+    referenceStart = referenceEnd - correlationLength
+    if referenceStart - correlationLag < referenceRead - referenceFilled:
+        return
+
+    positions = sampleAt(channel, sampleTime(reference, numpy.arange(referenceStart - correlationLag, referenceEnd + correlationLag)))
+    first = int(numpy.floor(positions[0]))
+    last = int(numpy.ceil(positions[-1])) + 1
+    if first < channelRead - channelFilled or last > channelRead:
+        return
+
+    channelValues = numpy.interp(positions, numpy.arange(first, last), getSpan(channel, ringIndex(channel, first), last - first))
+    referenceValues = getSpan(reference, ringIndex(reference, referenceStart), correlationLength)
+
+    channelValues = channelValues - channelValues.mean()
+    referenceValues = referenceValues - referenceValues.mean()
+    correlation = numpy.correlate(channelValues, referenceValues, "valid")
+
+    ## Only trust a clear match, away from the edge of where we looked
+    peak = int(numpy.argmax(correlation))
+    strength = correlation[peak] / (numpy.linalg.norm(channelValues[peak:peak + correlationLength]) * numpy.linalg.norm(referenceValues) + 1e-9)
+    if peak == 0 or peak == len(correlation) - 1 or strength < 0.5:
+        return
+
+    ## Fit a parabola through the peak to find it to a fraction of a sample
+    before, at, after = correlation[peak - 1:peak + 2]
+    lag = peak - correlationLag + 0.5 * (before - after) / (before - 2 * at + after)
+    channel["timingCorrection"] = channel["timingCorrection"] - lag / reference["timingRate"]
+
+def positionFrame(iterCount):
+
+    ## Work out where this frame starts in each channel's data buffer, lining the
+    ## trigger up with the pre-trigger point. Returns those starts, and each
+    ## frame's start as a count of samples read (for one shot triggers).
+    if channels[0]["triggerIndex"] >= 0:
+        return [channel["triggerIndex"] for channel in channels], None
+
+    ## Live data ends at the newest sample. Playback carries on from where we
+    ## left off, looking ahead for the next trigger.
+    frameEnds = [0] * len(channels)
+    samplesRead = [0] * len(channels)
+    available = [iterCount] * len(channels)
+
+    for n, channel in enumerate(channels):
+        channel["frameShift"] = 0.0
+        channel["frameScale"] = 1.0
+        channel["frameCount"] = iterCount
+
+        if channel["port"] is not None:
+            frameEnds[n], samplesRead[n], filled = latestSamples(channel)
+            available[n] = min(filled, iterCount + triggerSearch)
+        else:
+            available[n] = min(len(channel["dataBuffer"]), iterCount + triggerSearch)
+            frameEnds[n] = channel["dataIndex"] + available[n]
+            samplesRead[n] = frameEnds[n]
+
+    ## Each Nano samples on its own clock, and its data reaches us with its own
+    ## delays, so serial ports line up by when their samples were taken rather
+    ## than by how many we've read. The trigger channel is the reference, and
+    ## the frame can't go past the newest time that every port has data for.
+    source = channels[triggerChannel]
+    timed = []
+    latestSkipped = 0
+
+    if source["port"] is not None:
+        timed = [n for n, channel in enumerate(channels) if timedByArrival(channel) and estimateTiming(channel)]
+        if triggerChannel not in timed or len(timed) < 2:
+            timed = []
+
+    if len(timed) > 0:
+        global lastCorrelation
+        if args.align == "xcorr" and time.time() - lastCorrelation >= correlationInterval:
+            lastCorrelation = time.time()
+            for n in timed:
+                if n != triggerChannel:
+                    alignByCorrelation(source, channels[n])
+
+        latestTime = min(sampleTime(channels[n], samplesRead[n]) for n in timed)
+        latestSkipped = samplesRead[triggerChannel] - int(sampleAt(source, latestTime))
+        latestSkipped = max(0, min(latestSkipped, available[triggerChannel] - iterCount))
+
+    preTrigger = int(iterCount * min(100, max(0, args.pretrigger)) / 100)
+    samplesBeforeEnd = None
+
+    if source["trigger"] > 0:
+        ## Only look for triggers that leave room for the samples before and after
+        ## them, starting a little earlier so that the hysteresis can arm. Zoomed
+        ## out over a deep buffer, that's much less than the whole frame.
+        count = available[triggerChannel]
+        first = max(0, preTrigger - triggerLead)
+        last = count - latestSkipped - (iterCount - preTrigger)
+
+        values = getSpan(source, frameEnds[triggerChannel] - count + first, max(0, last - first + 1))
+        hysteresis = args.hysteresis / source["vref"] * source["peak"]
+        crossings = first + findTriggers(values, source["trigger"], hysteresis, triggerEdge == "rising")
+
+        crossings = crossings[crossings >= preTrigger]
+        positions = samplesRead[triggerChannel] - count + crossings
+
+        trigger = pickTrigger(positions, source["lastTrigger"], int(args.holdoff * source["sampleRate"]), source["port"] is not None)
+        if trigger is not None:
+            source["lastTrigger"] = trigger
+            samplesBeforeEnd = samplesRead[triggerChannel] - trigger + preTrigger
+
+    starts = [0] * len(channels)
+    frameStarts = [0] * len(channels)
+    referenceStart = samplesRead[triggerChannel] - (iterCount + latestSkipped if samplesBeforeEnd is None else samplesBeforeEnd)
+
+    for n, channel in enumerate(channels):
+        if samplesBeforeEnd is not None:
+            frameSamples = samplesBeforeEnd
+        elif channel["port"] is not None:
+            frameSamples = iterCount + latestSkipped
         else:
-            return inputData
+            frameSamples = available[n]
+
+        ## Start the other ports at the same moment as the reference, down to a
+        ## fraction of a sample, and resample them onto its timebase when drawing
+        if n in timed and n != triggerChannel:
+            start = sampleAt(channel, sampleTime(source, referenceStart))
+            frameSamples = samplesRead[n] - int(numpy.floor(start))
+            channel["frameShift"] = start - numpy.floor(start)
+            channel["frameScale"] = source["timingRate"] / channel["timingRate"]
+            channel["frameCount"] = min(len(channel["dataBuffer"]), int(numpy.ceil(iterCount / channel["frameScale"])) + 1)
+
+        starts[n] = (frameEnds[n] - frameSamples) % len(channel["dataBuffer"])
+        frameStarts[n] = samplesRead[n] - frameSamples
+        channel["frameIndex"] = starts[n]
+
+        ## Serial ports are captured and served as they are read. When playing
+        ## back a file, capture and serve what we play.
+        if channel["port"] is None:
+            channel["dataIndex"] = (starts[n] + iterCount) % len(channel["dataBuffer"])
+            if channel["triggerIndex"] < 0:
+                measureView(channel, starts[n], iterCount)
+
+            if channel["captureQueue"] is not None or serveLoop is not None:
+                played = viewSamples(channel, starts[n], iterCount)
+                captureSamples(channel, played)
+                serveSamples(channel, played, time.time())
+
+    if samplesBeforeEnd is None:
+        return starts, None
+
+    return starts, frameStarts
+
+## The spectrum view shows each channel's power per frequency in dB, where 0 dB
+## is a sine wave as large as the ADC can measure
+spectrumRange = 120
+spectrumSmoothing = 0.2
+spectrumHarmonics = 10
+
+def flatTopWindow(size):
+    phase = 2 * numpy.pi * numpy.arange(size) / (size - 1)
+    return (0.21557895 - 0.41663158 * numpy.cos(phase) + 0.277263158 * numpy.cos(2 * phase) -
+            0.083578947 * numpy.cos(3 * phase) + 0.006947368 * numpy.cos(4 * phase))
+
+## Each window, and how many bins either side of a tone its main lobe covers
+spectrumWindows = {"hann": (numpy.hanning, 2), "blackman": (numpy.blackman, 3), "flattop": (flatTopWindow, 5)}
+spectrumWeights = {}
+
+def spectrumPower(channel, values, windowName):
+
+    ## Window the samples (without their DC level, which would swamp everything
+    ## near it) and find the power in each bin of their real FFT
+    if (windowName, len(values)) not in spectrumWeights:
+        spectrumWeights[(windowName, len(values))] = spectrumWindows[windowName][0](len(values))
+    weights = spectrumWeights[(windowName, len(values))]
+
+    amplitudes = 2 * numpy.abs(numpy.fft.rfft((values - values.mean()) * weights)) / weights.sum()
+    return (amplitudes / (channel["peak"] / 2)) ** 2
+
+def measureSpectrum(power, binWidth, windowName):
+
+    ## The fundamental is the strongest bin past DC, placed between bins by fitting
+    ## a parabola to the levels around it. THD compares the power of each harmonic
+    ## below Nyquist to the fundamental's, taking in the whole lobe of each.
+    lobe = spectrumWindows[windowName][1]
+    if len(power) < 2 * lobe + 3:
+        return None
+
+    peak = lobe + 1 + int(numpy.argmax(power[lobe + 1:]))
+    delta = 0
+    if peak < len(power) - 1:
+        before, level, after = 10 * numpy.log10(power[peak - 1:peak + 2] + 1e-20)
+        if before - 2 * level + after < 0:
+            delta = 0.5 * (before - after) / (before - 2 * level + after)
+
+    fundamentalPower = power[peak - lobe:peak + lobe + 1].sum()
+    harmonicPower = 0
+    for harmonic in range(2, spectrumHarmonics + 1):
+        center = int(round(harmonic * (peak + delta)))
+        if center + lobe >= len(power):
+            break
+        harmonicPower = harmonicPower + power[center - lobe:center + lobe + 1].sum()
+
+    return {
+        "fundamental": (peak + delta) * binWidth,
+        "level": 10 * numpy.log10(power[peak] + 1e-20),
+        "thd": 100 * math.sqrt(harmonicPower / fundamentalPower) if fundamentalPower > 0 else 0
+    }
+
+## Headless analysis streams each channel through the same decoding and trigger
+## detection as the display, but writes out measurements of each window of
+## samples rather than drawing them. Memory use stays the same however long
+## the capture is.
+measurementFields = ["channel", "start", "end", "min", "max", "vpp", "mean", "rms", "frequency", "triggers"]
+
+def applyHoldoff(positions, lastTrigger, holdoff):
+
+    ## Drop any triggers that come within the holdoff of the one before them
+    if holdoff <= 0 or len(positions) == 0:
+        return positions
+
+    accepted = []
+    nextTrigger = 0
+    if lastTrigger is not None:
+        nextTrigger = numpy.searchsorted(positions, lastTrigger + holdoff)
+
+    while nextTrigger < len(positions):
+        accepted.append(positions[nextTrigger])
+        nextTrigger = numpy.searchsorted(positions, positions[nextTrigger] + holdoff)
+
+    return numpy.array(accepted, dtype = positions.dtype)
+
+def measureWindow(channel, values, firstSample):
+
+    ## Measure one window of samples. The trigger state carries on from the last
+    ## window, so that we don't miss edges that fall between them. Ports use
+    ## their measured sample rate once we know it.
+    if timedByArrival(channel):
+        estimateTiming(channel)
+    sampleRate = channel["timingRate"]
+    volts = values * (channel["vref"] / channel["peak"])
+    minValue = volts.min()
+    maxValue = volts.max()
+    meanValue = volts.mean()
+
+    ## Use rising edges through the middle of the signal to measure its frequency
+    edges = findTriggers(values, values.mean(), (values.max() - values.min()) / 10, True)
+    frequency = None
+    if len(edges) >= 2:
+        frequency = (len(edges) - 1) * sampleRate / (edges[-1] - edges[0])
+
+    triggers = numpy.zeros(0, dtype = numpy.int64)
+    if channel["trigger"] > 0:
+        level = channel["trigger"]
+        hysteresis = args.hysteresis / channel["vref"] * channel["peak"]
+        rising = args.edge == "rising"
+
+        searchValues = values
+        if channel["triggerCarry"] is not None:
+            searchValues = numpy.concatenate(([channel["triggerCarry"]], values))
+
+        triggers = firstSample + findTriggers(searchValues, level, hysteresis, rising) - (len(searchValues) - len(values))
+        triggers = applyHoldoff(triggers, channel["lastTrigger"], int(args.holdoff * sampleRate))
+        if len(triggers) > 0:
+            channel["lastTrigger"] = int(triggers[-1])
+
+        ## Remember the last sample that armed or fired the trigger
+        if rising:
+            decisive = numpy.flatnonzero((values < level - hysteresis) | (values >= level))
+        else:
+            decisive = numpy.flatnonzero((values > level + hysteresis) | (values <= level))
+        if len(decisive) > 0:
+            channel["triggerCarry"] = values[decisive[-1]]
+
+    ## Times count from the start of the file, even when playing only part of it
+    firstSample = firstSample + channel["playStart"]
+    triggers = triggers + channel["playStart"]
+
+    return {
+        "channel": channels.index(channel) + 1,
+        "start": firstSample / sampleRate,
+        "end": (firstSample + len(values)) / sampleRate,
+        "min": float(minValue),
+        "max": float(maxValue),
+        "vpp": float(maxValue - minValue),
+        "mean": float(meanValue),
+        "rms": float(numpy.sqrt(numpy.mean(volts * volts))),
+        "frequency": None if frequency is None else float(frequency),
+        "triggers": [float(trigger / sampleRate) for trigger in triggers]
+    }
+
+def readWindow(channel, position, count):
+
+    ## Get the next window of samples from a channel, starting at position (counting
+    ## from the first sample). Returns the samples and where they actually start,
+    ## or None if there are no more.
+    if channel["port"] is None:
+        count = min(count, len(channel["dataBuffer"]) - position)
+        if count <= 0:
+            return None, position
+
+        return getSpan(channel, position, count), position
+
+    with channel["dataReady"]:
+        if not channel["dataReady"].wait_for(lambda: channel["samplesRead"] >= position + count or channel["inputEnded"], timeout = 0.5):
+            return numpy.zeros(0), position
+
+        ## If we've fallen a whole buffer behind, skip up to the oldest samples we
+        ## still have, and count the ones we missed. Once the input has ended,
+        ## measure whatever's left of it.
+        oldest = channel["samplesRead"] - channel["samplesFilled"]
+        if position < oldest:
+            channel["samplesSkipped"] = channel["samplesSkipped"] + oldest - position
+            position = oldest
+        count = min(count, channel["samplesRead"] - position)
+        if count <= 0:
+            return None, position
+
+        return getSpan(channel, ringIndex(channel, position), count), position
+
+def writeMeasurement(output, writer, measurement):
+    if writer is None:
+        output.write(json.dumps(measurement) + "\n")
+        return
+
+    row = dict(measurement)
+    row["triggers"] = " ".join(format(trigger, ".6f") for trigger in measurement["triggers"])
+    writer.writerow(row)
+
+def windowSamples(channel, sampleRate):
+
+    ## Live ports can only look back as far as their ring buffer
+    count = max(1, parseSamplePosition(args.window, sampleRate))
+    if channel["port"] is not None and count > len(channel["dataBuffer"]) // 2:
+        count = len(channel["dataBuffer"]) // 2
+        if not channel["windowCapped"]:
+            channel["windowCapped"] = True
+            print("Windows of " + channel["input"] + " are cut to " + format(count / sampleRate, ".4g") + "s, half of what it keeps. Use --depth to keep more.",
+                  file = sys.stderr)
+
+    return count
+
+def analyze():
+    output = sys.stdout
+    if args.output is not None:
+        output = open(args.output, "w", newline = "")
+
+    writer = None
+    if args.format == "csv":
+        writer = csv.DictWriter(output, fieldnames = measurementFields)
+        writer.writeheader()
+
+    activeChannels = list(channels)
+    try:
+        while len(activeChannels) > 0:
+            for channel in list(activeChannels):
+                ## Ports and streams wait until their sample rate has been measured,
+                ## so that their windows are as long as asked and their times are
+                ## right from the first one
+                if timedByArrival(channel) and not estimateTiming(channel) and not channel["inputEnded"]:
+                    with channel["dataReady"]:
+                        channel["dataReady"].wait(timeout = 0.1)
+                    continue
+
+                channel["windowSize"] = windowSamples(channel, channel["timingRate"])
+                values, position = readWindow(channel, channel["dataIndex"], channel["windowSize"])
+                if values is None:
+                    activeChannels.remove(channel)
+                    continue
+
+                if len(values) > 0:
+                    writeMeasurement(output, writer, measureWindow(channel, values, position))
+
+                    ## Let a pipe waiting on us know that there's room for more
+                    with channel["dataReady"]:
+                        channel["dataIndex"] = position + len(values)
+                        channel["dataReady"].notify_all()
+
+    except KeyboardInterrupt:
+        pass
+
+    for channel in channels:
+        if channel["samplesSkipped"] > 0:
+            print(str(channel["samplesSkipped"]) + " samples of " + channel["input"] + " weren't measured, because they were read faster than they could be",
+                  file = sys.stderr)
+
+    if output is not sys.stdout:
+        output.close()
+
+## Measurements. As samples arrive (or are played back), each chunk of them is
+## summarised: its range, its sums, how much of it is above the middle of the
+## signal, and the rising edges through the middle. A channel's measurements
+## are of the chunks that make up its last measureTime seconds, so keeping them
+## up to date costs the same however long that is, and nothing ever scans the
+## ring buffer for them. Periods only count the time between edges that we saw
+## one after the other, so gaps in what's played back don't throw them off.
+measureTime = 0.5
+measureChunks = 4096
+measureHysteresis = 0.1
+measureRecord = numpy.dtype([("measured", "i8"), ("count", "i8"), ("min", "f8"), ("max", "f8"), ("sum", "f8"),
+                             ("sumSquares", "f8"), ("high", "i8"), ("periods", "i8"), ("periodSamples", "f8")])
+
+def createMeasurements():
+    return {
+        "chunks": numpy.zeros(measureChunks, dtype = measureRecord),
+        "chunkCount": 0,
+        "firstChunk": 0,
+        "measured": 0,
+        "end": None,
+        "carry": None,
+        "lastEdge": None,
+        "level": None,
+        "hysteresis": 0.0
+    }
+
+def windowChunks(measurements):
+
+    ## The summaries of the chunks in the window, oldest first
+    chunks = measurements["chunks"]
+    first = measurements["firstChunk"] % measureChunks
+    count = measurements["chunkCount"] - measurements["firstChunk"]
+    if first + count <= measureChunks:
+        return chunks[first:first + count]
+
+    return numpy.concatenate((chunks[first:], chunks[:first + count - measureChunks]))
+
+def measureSamples(channel, samples, firstSample):
+
+    ## Add a chunk of samples, which starts at firstSample, to the channel's
+    ## measurements. Edges carry on from the last chunk if this one follows it.
+    ## Anything that was already measured is left out, and going back to before
+    ## it (when playback starts again) starts the measurements again.
+    measurements = channel["measurements"]
+    if len(samples) == 0:
+        return
+    if measurements["end"] is not None and firstSample + len(samples) <= measurements["end"]:
+        measurements.update(createMeasurements())
+    if measurements["end"] is not None and firstSample < measurements["end"]:
+        samples = samples[measurements["end"] - firstSample:]
+        firstSample = measurements["end"]
+    if measurements["end"] is not None and firstSample > measurements["end"]:
+        measurements["carry"] = None
+        measurements["lastEdge"] = None
+
+    if len(samples) == 0:
+        return
+
+    ## Measure the samples as they're displayed
+    values = samples.astype(float)
+    if channel["invert"]:
+        values = channel["peak"] - values
+
+    if measurements["level"] is None:
+        measurements["level"] = (values.min() + values.max()) / 2
+        measurements["hysteresis"] = (values.max() - values.min()) * measureHysteresis
+    level = measurements["level"]
+    hysteresis = measurements["hysteresis"]
+
+    searchValues = values
+    if measurements["carry"] is not None:
+        searchValues = numpy.concatenate(([measurements["carry"]], values))
+    edges = firstSample + findTriggers(searchValues, level, hysteresis, True) - (len(searchValues) - len(values))
+
+    decisive = numpy.flatnonzero((values < level - hysteresis) | (values >= level))
+    if len(decisive) > 0:
+        measurements["carry"] = values[decisive[-1]]
+
+    ## Count the periods that end in this chunk
+    periods = len(edges)
+    periodSamples = 0
+    if len(edges) > 0:
+        if measurements["lastEdge"] is None:
+            measurements["lastEdge"] = edges[0]
+            periods = periods - 1
+        periodSamples = edges[-1] - measurements["lastEdge"]
+        measurements["lastEdge"] = edges[-1]
+
+    with channel["dataReady"]:
+        chunks = measurements["chunks"]
+        measurements["measured"] = measurements["measured"] + len(values)
+        chunks[measurements["chunkCount"] % measureChunks] = (measurements["measured"], len(values), values.min(), values.max(), values.sum(),
+                                                              numpy.dot(values, values), numpy.count_nonzero(values >= level), periods, periodSamples)
+        measurements["chunkCount"] = measurements["chunkCount"] + 1
+        measurements["end"] = firstSample + len(values)
+
+        ## Let go of the chunks that have left the window
+        windowStart = measurements["measured"] - measureTime * channel["timingRate"]
+        first = max(measurements["firstChunk"], measurements["chunkCount"] - measureChunks)
+        while chunks[first % measureChunks]["measured"] <= windowStart:
+            first = first + 1
+        measurements["firstChunk"] = first
+
+        ## Look for edges through the middle of what's in the window next time
+        window = windowChunks(measurements)
+        low = window["min"].min()
+        high = window["max"].max()
+        measurements["level"] = (low + high) / 2
+        measurements["hysteresis"] = (high - low) * measureHysteresis
+
+def measureView(channel, start, count):
+
+    ## Measure what playback has moved on to since the last frame. Only the last
+    ## measureTime of it can count, so however far the view jumps (zoomed out
+    ## over a long capture, or starting again from the beginning), that's all
+    ## that's read. A view that hasn't moved has nothing new to measure.
+    end = start + count
+    if end == channel["measurements"]["end"]:
+        return
+
+    first = max(start, end - int(math.ceil(measureTime * channel["timingRate"])))
+    if channel["measurements"]["end"] is not None and channel["measurements"]["end"] < end:
+        first = max(first, channel["measurements"]["end"])
+    measureSamples(channel, viewSamples(channel, first, end - first), first)
+
+def readMeasurements(channel):
+
+    ## The channel's measurements, in volts and seconds, or None before it has any
+    with channel["dataReady"]:
+        window = windowChunks(channel["measurements"]).copy()
+
+    count = window["count"].sum()
+    if count == 0:
+        return None
+
+    volts = channel["vref"] / channel["peak"]
+    periods = window["periods"].sum()
+    periodSamples = window["periodSamples"].sum()
+    frequency = None
+    if periods > 0 and periodSamples > 0:
+        frequency = periods * channel["timingRate"] / periodSamples
+
+    return {
+        "min": float(window["min"].min() * volts),
+        "max": float(window["max"].max() * volts),
+        "vpp": float((window["max"].max() - window["min"].min()) * volts),
+        "mean": float(window["sum"].sum() / count * volts),
+        "rms": math.sqrt(window["sumSquares"].sum() / count) * volts,
+        "frequency": None if frequency is None else float(frequency),
+        "period": None if frequency is None else float(1 / frequency),
+        "duty": None if frequency is None else float(window["high"].sum() / count)
+    }
+
+def describeMeasurements(measurements):
+    if measurements is None:
+        return ""
+
+    text = (format(measurements["vpp"], ".2f") + "Vpp, mean " + format(measurements["mean"], ".2f") + "V, RMS " +
+            format(measurements["rms"], ".2f") + "V")
+    if measurements["frequency"] is not None:
+        text = (text + ", " + format(measurements["frequency"], ".1f") + "Hz (" + format(measurements["period"] * 1000, ".3f") +
+                "ms), duty " + format(measurements["duty"] * 100, ".1f") + "%")
+
+    return text
+
+## Readers start once everything they use is defined
+for channel in channels:
+    channel["measurements"] = createMeasurements()
+    if channel["port"] is not None:
+        startReader(channel)
+
+startMetrics()
+startServing()
 
-    except Exception as e:
-        print(e)
-        inputData = 0
+if args.headless:
+    analyze()
 
-    if channel["captureFile"] is not None:
-        channel["captureFile"].write(inputData.to_bytes(2, 'big'))
+    for channel in channels:
+        stopReader(channel)
+        stopCapture(channel)
+    sys.exit(0)
 
+## Everything from here on is the display. Only import pyglet now, so that
+## headless analysis runs on machines without a display or OpenGL.
+import pyglet
+
+from pyglet import shapes
+from pyglet.gl import *
+from pyglet.window import mouse
+from pyglet.window import key
 
 def update(dt):
-    pass
+
+    ## Only draw a frame when there's something new to show: samples that have
+    ## arrived since the last one, file playback, or a change to the view. When
+    ## the signal stops, we stop too and leave the CPU idle.
+    global redrawNeeded
+
+    for channel in channels:
+        if channel["port"] is not None:
+            if channel["samplesWaiting"] > 0:
+                redrawNeeded = True
+        elif channel["triggerIndex"] < 0 or channel["pyramidFilled"] < len(channel["dataBuffer"]):
+            redrawNeeded = True
+
+    ## Keep drawing while the XY phosphor is still fading out
+    if xy and not spectrum and phosphor["lit"]:
+        redrawNeeded = True
+
+    if redrawNeeded:
+        redrawNeeded = False
+        window.draw(dt)
+
+def spectrumSamples(channel):
+
+    ## Transform the latest samples while a port is running. When paused, or
+    ## playing back a file, transform the samples up to the end of the view.
+    ## Returns them, and a marker for which samples they were.
+    with channel["dataReady"]:
+        if channel["port"] is not None and channel["triggerIndex"] < 0:
+            count = min(args.fftsize, channel["samplesFilled"])
+            return getSpan(channel, channel["writeIndex"] - count, count), channel["samplesRead"]
+
+        start = channel["triggerIndex"] if channel["triggerIndex"] >= 0 else channel["frameIndex"]
+        end = (start + channel["frameCount"]) % len(channel["dataBuffer"])
+        count = min(args.fftsize, len(channel["dataBuffer"]))
+        return getSpan(channel, end - count, count), end
+
+def updateSpectrum(channel):
+
+    ## Average the newest spectrum into the ones before it. Returns whether
+    ## there's anything new to show.
+    values, end = spectrumSamples(channel)
+    settings = (len(values), spectrumWindow, spectrumAveraging)
+    if len(values) < 16 or (end == channel["spectrumEnd"] and settings == channel["spectrumSettings"]):
+        return False
+
+    power = spectrumPower(channel, values, spectrumWindow)
+    average = channel["spectrumAverage"]
+
+    if average is None or settings != channel["spectrumSettings"] or spectrumAveraging == "none":
+        average = power
+    elif spectrumAveraging == "exponential":
+        average = average + spectrumSmoothing * (power - average)
+    else:
+        average = numpy.maximum(average, power)
+
+    channel["spectrumAverage"] = average
+    channel["spectrumSettings"] = settings
+    channel["spectrumEnd"] = end
+
+    ## Ports we've measured the timing of use their real sample rate
+    binWidth = channel["timingRate"] / len(values)
+    channel["spectrum"] = {"power": average, "binWidth": binWidth, "readout": measureSpectrum(average, binWidth, spectrumWindow)}
+    return True
+
+def runSpectrum():
+
+    ## Transforms of up to 65536 points take long enough to drop frames, so they
+    ## run here rather than while drawing. Only wakes up in spectrum mode.
+    global redrawNeeded
+
+    while True:
+        spectrumWake.wait()
+        for channel in channels:
+            if updateSpectrum(channel):
+                redrawNeeded = True
+        time.sleep(1 / args.fps)
 
 oneShot = args.oneshot
+oneShotStarts = None
+triggerChannel = args.triggerchannel - 1
+triggerEdge = args.edge
 xy = args.xy
+spectrum = args.spectrum
+spectrumWindow = args.fftwindow
+spectrumAveraging = args.fftaverage
+
+spectrumWake = threading.Event()
+if spectrum:
+    spectrumWake.set()
+threading.Thread(target = runSpectrum, daemon = True).start()
 
 mousePos = 0, 0
 mouseDragStart = 0, 0
 currentFrame = 0
+redrawNeeded = True
+overlayOn = args.overlay
+overlayText = ""
+channelMeasurements = [None] * len(channels)
 
 window = pyglet.window.Window(resizable=True)
-pyglet.clock.schedule_interval(update, 1/30.0)
+pyglet.clock.schedule_interval(update, 1 / args.fps)
+
+## The traces are drawn from one persistent vertex list per channel, rather than
+## a shape per sample. Their vertices are updated in place from NumPy every frame.
+traceVertexSource = """#version 150 core
+    in vec2 position;
+    in vec4 colors;
+    out vec4 vertex_colors;
+
+    uniform WindowBlock
+    {
+        mat4 projection;
+        mat4 view;
+    } window;
+
+    void main()
+    {
+        gl_Position = window.projection * window.view * vec4(position, 0.0, 1.0);
+        vertex_colors = colors;
+    }
+"""
+
+traceFragmentSource = """#version 150 core
+    in vec4 vertex_colors;
+    out vec4 final_color;
+
+    void main()
+    {
+        final_color = vertex_colors;
+    }
+"""
+
+traceProgram = window.context.create_program((traceVertexSource, 'vertex'), (traceFragmentSource, 'fragment'))
+traceBatch = pyglet.graphics.Batch()
+
+def createTrace(color):
+    return {"vertexList": None, "capacity": 0, "count": 0, "color": color}
+
+def resizeTrace(trace, capacity):
+
+    ## (Re)allocate the vertex list. This only happens when the window is resized,
+    ## or when more points are needed than we've ever drawn before.
+    if trace["vertexList"] is not None:
+        trace["vertexList"].delete()
+
+    trace["vertexList"] = traceProgram.vertex_list(capacity, GL_LINE_STRIP, batch = traceBatch,
+                                                   position = ('f', [0] * 2 * capacity),
+                                                   colors = ('Bn', trace["color"] * capacity))
+    trace["capacity"] = capacity
+    trace["count"] = 0
+
+def updateTrace(trace, xPos, yPos):
+    count = len(xPos)
+    trace["count"] = count
+    if count == 0:
+        return
+
+    if count > trace["capacity"]:
+        resizeTrace(trace, count)
+        trace["count"] = count
+
+    ## Write straight into the vertex list's memory. Any vertices we don't need this
+    ## frame are collapsed onto the last point so that they don't draw anything.
+    positions = numpy.ctypeslib.as_array(trace["vertexList"].position).reshape(-1, 2)
+    positions[:count, 0] = xPos
+    positions[:count, 1] = yPos
+    positions[count:] = positions[count - 1]
+
+def drawTrace(trace, mode):
+    if trace["count"] > 0:
+        traceProgram.use()
+        trace["vertexList"].draw(mode)
+        traceProgram.stop()
+
+## Each channel's colour, going around again if there are more channels than colours
+channelColors = [(120, 120, 220, 255), (120, 220, 120, 255), (220, 120, 120, 255), (220, 220, 120, 255),
+                 (120, 220, 220, 255), (220, 120, 220, 255), (220, 170, 100, 255), (200, 200, 200, 255)]
+traces = [createTrace(channelColors[n % len(channelColors)]) for n in range(len(channels))]
+
+## Text and shapes on top of the traces are kept from frame to frame in their own
+## batch. Laying text out is slow, so a label is only changed when its text,
+## position or style does, and labels that aren't shown this frame are hidden.
+hudBatch = pyglet.graphics.Batch()
+hudLabels = {}
+hudShown = set()
+
+dragRectangle = shapes.BorderedRectangle(0, 0, 1, 1, border=1, color = (255, 255, 255), border_color = (255, 255, 255), batch = hudBatch)
+dragRectangle.opacity = 100
+dragRectangle.visible = False
+
+def showLabel(name, text, **properties):
+    label = hudLabels.get(name)
+    if label is None:
+        hudLabels[name] = pyglet.text.Label(text, batch = hudBatch, **properties)
+    else:
+        properties["text"] = text
+        for labelKey, value in properties.items():
+            if getattr(label, labelKey) != value:
+                setattr(label, labelKey, value)
+
+        if not label.visible:
+            label.visible = True
+
+    hudShown.add(name)
+
+def hideLabels():
+
+    ## Hide the labels that weren't shown this frame, ready for the next one
+    for name, label in hudLabels.items():
+        if name not in hudShown and label.visible:
+            label.visible = False
+
+    hudShown.clear()
+
+grid = createTrace((100, 100, 100, 255))
+
+## XY mode draws like the phosphor of a CRT. The beam sweeps from each sample to
+## the next, brightening the pixels it crosses in an intensity image that fades
+## exponentially. Each sample's energy is spread along its sweep, so the beam is
+## brighter where it moves slowly. The image is only as large as the window, so
+## the cost of drawing it doesn't depend on how many samples there are.
+phosphorHit = 8
+phosphorVisible = 0.01
+
+## Most points to light per frame. Sweeps are drawn more coarsely past this.
+phosphorBudget = 100000
+
+phosphorFragmentSource = """#version 150 core
+    in vec2 texture_position;
+    out vec4 final_color;
+
+    uniform sampler2D intensity;
+    uniform vec4 color;
+
+    void main()
+    {
+        float glow = 1.0 - exp(-texture(intensity, texture_position).r);
+        final_color = vec4(color.rgb * glow, 1.0);
+    }
+"""
+
+phosphorVertexSource = """#version 150 core
+    in vec2 position;
+    in vec2 texture;
+    out vec2 texture_position;
+
+    uniform WindowBlock
+    {
+        mat4 projection;
+        mat4 view;
+    } window;
+
+    void main()
+    {
+        gl_Position = window.projection * window.view * vec4(position, 0.0, 1.0);
+        texture_position = texture;
+    }
+"""
+
+phosphorProgram = window.context.create_program((phosphorVertexSource, 'vertex'), (phosphorFragmentSource, 'fragment'))
+phosphor = {"image": None, "textures": [], "vertexList": None, "updated": None, "lit": False, "beam": None}
+
+def resizePhosphor(width, height):
+
+    ## Start with a dark screen the size of the window
+    if phosphor["vertexList"] is not None:
+        phosphor["vertexList"].delete()
+        for texture in phosphor["textures"]:
+            texture.delete()
+
+    phosphor["image"] = numpy.zeros((height, width), dtype = numpy.float32)
+    ## Take turns uploading to two textures, so that we never have to wait for
+    ## the GPU to finish drawing the last frame from the one we're changing
+    phosphor["textures"] = [pyglet.image.Texture.create(width, height, internalformat = GL_R32F, fmt = GL_RED) for n in range(2)]
+    phosphor["vertexList"] = phosphorProgram.vertex_list(4, GL_TRIANGLE_STRIP,
+                                                         position = ('f', [0, 0, width, 0, 0, height, width, height]),
+                                                         texture = ('f', [0, 0, 1, 0, 0, 1, 1, 1]))
+    phosphor["updated"] = None
+    phosphor["lit"] = False
+    phosphor["beam"] = None
+
+## Without a display, the window can draw before it's first resized
+resizePhosphor(window.width, window.height)
+
+def updatePhosphor(xPos, yPos):
+
+    ## Fade what's there for however long it's been, then add the new samples
+    image = phosphor["image"]
+    now = time.perf_counter()
+    if phosphor["updated"] is not None:
+        if args.persistence > 0:
+            image *= math.exp(-(now - phosphor["updated"]) / args.persistence)
+        else:
+            image[:] = 0
+    phosphor["updated"] = now
+
+    ## Sweep on from wherever the beam was left at the end of the last frame
+    if len(xPos) > 0:
+        if phosphor["beam"] is not None:
+            xPos = numpy.concatenate(([phosphor["beam"][0]], xPos))
+            yPos = numpy.concatenate(([phosphor["beam"][1]], yPos))
+        phosphor["beam"] = xPos[-1], yPos[-1]
+
+    if len(xPos) > 1:
+        ## Light a point about every pixel along each sweep
+        lengths = numpy.hypot(numpy.diff(xPos), numpy.diff(yPos))
+        detail = min(1, phosphorBudget / max(1, lengths.sum()))
+        steps = numpy.maximum(1, numpy.ceil(lengths * detail)).astype(int)
+
+        sweeps = numpy.repeat(numpy.arange(len(steps)), steps)
+        fractions = (numpy.arange(len(sweeps)) - numpy.repeat(numpy.cumsum(steps) - steps, steps)) / steps[sweeps]
+        columns = (xPos[sweeps] + fractions * (xPos[sweeps + 1] - xPos[sweeps])).astype(int)
+        rows = (yPos[sweeps] + fractions * (yPos[sweeps + 1] - yPos[sweeps])).astype(int)
+
+        onScreen = (columns >= 0) & (columns < image.shape[1]) & (rows >= 0) & (rows < image.shape[0])
+        pixels, hits = numpy.unique(rows[onScreen] * image.shape[1] + columns[onScreen], return_inverse = True)
+        image.ravel()[pixels] += numpy.bincount(hits, phosphorHit / steps[sweeps[onScreen]]).astype(numpy.float32)
+
+    phosphor["lit"] = image.max() > phosphorVisible
+
+    phosphor["textures"].reverse()
+    texture = phosphor["textures"][0]
+    glBindTexture(texture.target, texture.id)
+    glTexSubImage2D(texture.target, 0, 0, 0, image.shape[1], image.shape[0], GL_RED, GL_FLOAT, image.ctypes.data)
+
+def drawPhosphor(color):
+
+    ## Add the glow over the grid
+    glActiveTexture(GL_TEXTURE0)
+    texture = phosphor["textures"][0]
+    glBindTexture(texture.target, texture.id)
+    glEnable(GL_BLEND)
+    glBlendFunc(GL_ONE, GL_ONE)
+
+    phosphorProgram.use()
+    phosphorProgram['intensity'] = 0
+    phosphorProgram['color'] = [component / 255 for component in color]
+    phosphor["vertexList"].draw(GL_TRIANGLE_STRIP)
+    phosphorProgram.stop()
+
+    glDisable(GL_BLEND)
+
+@window.event
+def on_expose():
+    global redrawNeeded
+    redrawNeeded = True
+
+@window.event
+def on_resize(width, height):
+    global redrawNeeded
+    redrawNeeded = True
+
+    ## Size the traces for the window. A zoom of 0.5 or more then fits without reallocating.
+    for trace in traces:
+        resizeTrace(trace, 2 * width)
+    resizePhosphor(width, height)
+
+    ## The graph lines only change when the window does
+    lines = list(range(0, height - 80, 10))
+    resizeTrace(grid, max(1, 2 * len(lines)))
+    updateTrace(grid, numpy.tile([0, width], len(lines)), numpy.repeat(lines, 2) + 40)
+
+    colors = numpy.ctypeslib.as_array(grid["vertexList"].colors).reshape(-1, 4)
+    for index, line in enumerate(lines):
+        if line % 100 == 0:
+            colors[2 * index:2 * index + 2] = (200, 200, 200, 255)
 
 @window.event
 def on_mouse_motion(x, y, dx, dy):
-    global mousePos
+    global mousePos, redrawNeeded
+    redrawNeeded = True
     mousePos = x, y
 
 @window.event
 def on_mouse_press(x, y, buttons, modifiers):
-    global mouseDragStart
+    global mouseDragStart, redrawNeeded
+    redrawNeeded = True
     mouseDragStart = x, y
 
 @window.event
 def on_mouse_drag(x, y, dx, dy, buttons, modifiers):
-    global mousePos
+    global mousePos, redrawNeeded
+    redrawNeeded = True
     mousePos = x, y
 
 @window.event
 def on_mouse_release(x, y, button, modifiers):
-    global mouseDragStart
+    global mouseDragStart, redrawNeeded
+    redrawNeeded = True
     mouseDragStart = 0, 0
 
+## Auto-set fits each channel's signal to autoSetFill of the screen's height,
+## triggers through its middle, and zooms to show autoSetPeriods periods of the
+## trigger channel. It only reads the measurements, so it's instant however
+## much history there is.
+autoSetFill = 0.8
+autoSetPeriods = 3
+
+def autoSet():
+    for channel in channels:
+        measurements = readMeasurements(channel)
+        if measurements is None:
+            continue
+
+        low = measurements["min"] / channel["vref"] * channel["peak"]
+        high = measurements["max"] / channel["vref"] * channel["peak"]
+        middle = (low + high) / 2
+        if high - low > channel["peak"] / 1000:
+            channel["scale"] = autoSetFill * channel["peak"] / (high - low)
+            channel["trigger"] = middle
+        channel["offset"] = int(round(channel["peak"] / 2 / channel["scale"] - middle))
+
+    measurements = readMeasurements(channels[triggerChannel])
+    if measurements is not None and measurements["frequency"] is not None:
+        periodSamples = channels[triggerChannel]["timingRate"] / measurements["frequency"]
+        for channel in channels:
+            channel["zoom"] = max(window.width / (autoSetPeriods * periodSamples), window.width / len(channel["dataBuffer"]))
+
 @window.event
 def on_key_press(symbol, modifiers):
+    global redrawNeeded
+    redrawNeeded = True
 
     ## X
     ## Toggle XY mode
-    if symbol == key.X:
+    if symbol == key.X and len(channels) > 1:
         global xy
         xy = not xy
 
+    ## F
+    ## Toggle the spectrum view
+    global spectrum, spectrumWindow, spectrumAveraging
+    if symbol == key.F:
+        spectrum = not spectrum
+        if spectrum:
+            spectrumWake.set()
+        else:
+            spectrumWake.clear()
+
+    ## W
+    ## Use the next spectrum window
+    if symbol == key.W:
+        names = list(spectrumWindows)
+        spectrumWindow = names[(names.index(spectrumWindow) + 1) % len(names)]
+
+    ## A
+    ## Use the next kind of spectrum averaging, starting it again
+    if symbol == key.A:
+        kinds = ["none", "exponential", "peak"]
+        spectrumAveraging = kinds[(kinds.index(spectrumAveraging) + 1) % len(kinds)]
+
     ## T
     ## Reset triggers
     if symbol == key.T:
-        channels[0]["trigger"] = channels[0]["originalTrigger"]
-        channels[1]["trigger"] = channels[1]["originalTrigger"]
+        for channel in channels:
+            channel["trigger"] = channel["originalTrigger"]
+
+    ## E
+    ## Trigger on the other edge
+    if symbol == key.E:
+        global triggerEdge
+        triggerEdge = "falling" if triggerEdge == "rising" else "rising"
+
+    ## C
+    ## Trigger on the next channel
+    if symbol == key.C:
+        global triggerChannel
+        triggerChannel = (triggerChannel + 1) % len(channels)
+
+    ## R, L, H, D
+    ## Change how live inputs are processed: the next amount of averaging, and
+    ## toggle the low-pass and high-pass filters, and DC removal. Filters that
+    ## weren't given a frequency start at a fraction of the sample rate.
+    for channel in channels:
+        if channel["processing"] is None:
+            if symbol in (key.R, key.L, key.H, key.D):
+                channel["processingIgnored"] = True
+            continue
+
+        if symbol == key.R:
+            setProcessing(channel, average = channel["average"] * 2 if channel["average"] * 2 <= maxAverage else 1)
+
+        if symbol == key.L:
+            channel["lowpassCutoff"] = channel["lowpassCutoff"] or defaultLowpass * channel["timingRate"]
+            setProcessing(channel, lowpass = None if channel["lowpass"] is not None else channel["lowpassCutoff"])
+
+        if symbol == key.H:
+            channel["highpassCutoff"] = channel["highpassCutoff"] or defaultHighpass * channel["timingRate"]
+            setProcessing(channel, highpass = None if channel["highpass"] is not None else channel["highpassCutoff"])
+
+        if symbol == key.D:
+            setProcessing(channel, dcRemove = not channel["dcRemove"])
+
+    ## S
+    ## Auto-set the trigger, scales and offsets to the signal
+    if symbol == key.S:
+        autoSet()
 
     ## Ctrl +/-/0
     ## Change the horizontal scale
-    if symbol == key.EQUAL and (modifiers & key.MOD_CTRL):
-        channels[0]["zoom"] = channels[0]["zoom"] * 1.1
-        channels[1]["zoom"] = channels[1]["zoom"] * 1.1
+    for channel in channels:
+        if symbol == key.EQUAL and (modifiers & key.MOD_CTRL):
+            channel["zoom"] = channel["zoom"] * 1.1
 
-    if symbol == key.MINUS and (modifiers & key.MOD_CTRL):
-        channels[0]["zoom"] = channels[0]["zoom"] / 1.1
-        channels[1]["zoom"] = channels[1]["zoom"] / 1.1
+        if symbol == key.MINUS and (modifiers & key.MOD_CTRL):
+            ## Zoom out as far as the whole data buffer
+            channel["zoom"] = max(channel["zoom"] / 1.1, window.width / len(channel["dataBuffer"]))
 
-    if symbol == key._0 and (modifiers & key.MOD_CTRL):
-        channels[0]["zoom"] = 1.0
-        channels[1]["zoom"] = 1.0
+        if symbol == key._0 and (modifiers & key.MOD_CTRL):
+            channel["zoom"] = 1.0
 
     ## Alt +/-/0
     ## Change the vertical scale
-    if symbol == key.EQUAL and (modifiers & key.MOD_ALT):
-        channels[0]["scale"] = channels[0]["scale"] * 1.1
-        channels[1]["scale"] = channels[1]["scale"] * 1.1
+    for channel in channels:
+        if symbol == key.EQUAL and (modifiers & key.MOD_ALT):
+            channel["scale"] = channel["scale"] * 1.1
 
-    if symbol == key.MINUS and (modifiers & key.MOD_ALT):
-        channels[0]["scale"] = channels[0]["scale"] / 1.1
-        channels[1]["scale"] = channels[1]["scale"] / 1.1
+        if symbol == key.MINUS and (modifiers & key.MOD_ALT):
+            channel["scale"] = channel["scale"] / 1.1
 
-    if symbol == key._0 and (modifiers & key.MOD_ALT):
-        channels[0]["scale"] = 1.0
-        channels[1]["scale"] = 1.0
+        if symbol == key._0 and (modifiers & key.MOD_ALT):
+            channel["scale"] = 1.0
 
     ## Left, Right, Home
-    ## Scroll the view
-    if symbol == key.RIGHT:
-        ## Use the current data posision if we don't already have one
-        if channels[0]["triggerIndex"] < 0:
-            channels[0]["triggerIndex"] = channels[0]["dataIndex"]
-            channels[1]["triggerIndex"] = channels[1]["dataIndex"]
-
-        if modifiers & key.MOD_CTRL:
-            channels[0]["triggerIndex"] = channels[0]["triggerIndex"] + 400
-            channels[1]["triggerIndex"] = channels[1]["triggerIndex"] + 400
-        else:
-            channels[0]["triggerIndex"] = channels[0]["triggerIndex"] + 20
-            channels[1]["triggerIndex"] = channels[1]["triggerIndex"] + 20
-
-        if channels[0]["triggerIndex"] >= len(channels[0]["dataBuffer"]):
-            channels[0]["triggerIndex"] = channels[0]["triggerIndex"] - len(channels[0]["dataBuffer"])
-
-        if channels[1]["triggerIndex"] >= len(channels[1]["dataBuffer"]):
-            channels[1]["triggerIndex"] = channels[1]["triggerIndex"] - len(channels[1]["dataBuffer"])
-
-    if symbol == key.LEFT:
-        ## Use the current data posision if we don't already have one
-        if channels[0]["triggerIndex"] < 0:
-            channels[0]["triggerIndex"] = channels[0]["dataIndex"]
-            channels[1]["triggerIndex"] = channels[1]["dataIndex"]
-
-        if modifiers & key.MOD_CTRL:
-            channels[0]["triggerIndex"] = channels[0]["triggerIndex"] - 400
-            channels[1]["triggerIndex"] = channels[1]["triggerIndex"] - 400
-        else:
-            channels[0]["triggerIndex"] = channels[0]["triggerIndex"] - 20
-            channels[1]["triggerIndex"] = channels[1]["triggerIndex"] - 20
-
-        if channels[0]["triggerIndex"] < 0:
-            channels[0]["triggerIndex"] = len(channels[0]["dataBuffer"]) + channels[0]["triggerIndex"]
-
-        if channels[1]["triggerIndex"] < 0:
-            channels[1]["triggerIndex"] = len(channels[1]["dataBuffer"]) + channels[1]["triggerIndex"]
+    ## Scroll the view. Steps are a fixed distance on screen, so they cover more
+    ## samples when zoomed out. With Shift, jump to the next or previous trigger
+    ## anywhere in the history.
+    smallStep = max(1, int(10 / channels[0]["zoom"]))
+    largeStep = max(1, int(200 / channels[0]["zoom"]))
+
+    seekStep = None
+    if (symbol == key.RIGHT or symbol == key.LEFT) and modifiers & key.MOD_SHIFT:
+        source = channels[triggerChannel]
+        start = source["triggerIndex"] if source["triggerIndex"] >= 0 else source["frameIndex"]
+        seekStep = seekTrigger(source, start, symbol == key.RIGHT)
+        if seekStep is None:
+            return pyglet.event.EVENT_HANDLED
+
+    for channel in channels:
+        if symbol == key.RIGHT or symbol == key.LEFT:
+            ## Use the current data posision if we don't already have one
+            if channel["triggerIndex"] < 0:
+                channel["triggerIndex"] = channel["frameIndex"]
+
+            step = largeStep if modifiers & key.MOD_CTRL else smallStep
+            if symbol == key.LEFT:
+                step = -step
+            if seekStep is not None:
+                step = seekStep
+
+            channel["triggerIndex"] = (channel["triggerIndex"] + step) % len(channel["dataBuffer"])
+
+        if symbol == key.HOME:
+            if channel["oneShotHome"] > 0:
+                channel["triggerIndex"] = channel["oneShotHome"]
+            else:
+                channel["triggerIndex"] = oldestIndex(channel)
 
-    if symbol == key.HOME:
-        if channels[0]["oneShotHome"] > 0:
-            channels[0]["triggerIndex"] = channels[0]["oneShotHome"]
-        else:
-            channels[0]["triggerIndex"] = 0
-
-        if channels[1]["oneShotHome"] > 0:
-            channels[1]["triggerIndex"] = channels[1]["oneShotHome"]
-        else:
-            channels[1]["triggerIndex"] = 0
+    ## I
+    ## Toggle the timing overlay
+    if symbol == key.I:
+        global overlayOn, overlayText
+        overlayOn = not overlayOn
+        overlayText = describeMetrics(metricsSnapshot())
 
     ## Escape
     ## Go back to live view
     if symbol == key.ESCAPE:
-        channels[0]["triggerIndex"] = -1
-        channels[1]["triggerIndex"] = -1
+        for channel in channels:
+            channel["triggerIndex"] = -1
         return pyglet.event.EVENT_HANDLED        
 
 @window.event
 def on_draw():
+    global overlayText, channelMeasurements, currentFrame
     frameBegin = time.perf_counter()
-    batch = pyglet.graphics.Batch()
 
-    ## Figure out how many data points we'll need this frame
-    ## For XY mode, assume 400. Given the bandwidth of an Arduino
-    ## Nano, More than that starts to drop frame rate.
-    if xy:
-        iterCount = 300
+    ## Measurements are kept up to date as samples arrive. Reading them a few
+    ## times a second is plenty to read them by.
+    if currentFrame % 10 == 0:
+        channelMeasurements = [readMeasurements(channel) for channel in channels]
+
+    ## Figure out how many data points we'll need this frame. XY mode draws
+    ## every sample that has arrived since the last frame, or plays a file
+    ## back at its own sample rate.
+    xyCount = 0
+    if xy and not spectrum:
+        source = channels[triggerChannel]
+        if source["port"] is not None:
+            xyCount = source["samplesWaiting"]
+        elif source["triggerIndex"] < 0:
+            xyCount = int(source["timingRate"] / args.fps)
+        iterCount = max(1, xyCount)
     else:
         iterCount = int(window.width / channels[0]["zoom"])
 
-    ## Wait to buffer enough samples to satisfy the entire frame, and then
-    ## toss the rest. This keeps us reading the most current data, avoiding
-    ## latency issues (single channel), and differing data rates (dual channel)
-    if channels[0]["port"] is not None:
-        while channels[0]["port"].in_waiting < iterCount:
-            pass
-        waiting0 = channels[0]["port"].in_waiting
-        channels[0]["port"].read(waiting0 - iterCount)
-
-    if channels[1]["port"] is not None:
-        while channels[1]["port"].in_waiting < iterCount:
-            pass
-        waiting1 = channels[1]["port"].in_waiting
-        channels[1]["port"].read(waiting1 - iterCount)
-   
+    for channel in channels:
+        iterCount = min(iterCount, len(channel["dataBuffer"]))
+    xyCount = min(xyCount, iterCount)
+
+    ## The spectrum's frequency axis is shared by every channel. Zooming in
+    ## shows the lower frequencies in more detail.
+    topFrequency = max(channel["timingRate"] for channel in channels) / 2 / max(1, channels[0]["zoom"])
+
     ## If we are in X-Y mode, disable triggering
-    if xy:
-        channels[0]["trigger"] = -1
-        channels[1]["trigger"] = -1
-        label = pyglet.text.Label('X-Y mode on ' + channels[0]["input"] + " and "  + channels[1]["input"],
-                                font_size=15,
-                                x=window.width / 2,
-                                y=window.height - 20,
-                                anchor_x='center',
-                                anchor_y='center',
-                                batch = batch)
+    if xy and not spectrum:
+        for channel in channels:
+            channel["trigger"] = -1
+        showLabel("xy", 'X-Y mode on ' + channels[0]["input"] + " and "  + channels[1]["input"],
+                  font_size=15,
+                  x=window.width / 2,
+                  y=window.height - 20,
+                  anchor_x='center',
+                  anchor_y='center')
     else:
-        label = pyglet.text.Label(channels[0]["input"],
-                                font_size=15,
-                                x=window.width / 2,
-                                y=window.height - 20,
-                                anchor_x='center',
-                                anchor_y='center',
-                                batch = batch)
-        label.color = (120, 120, 220, 255)
-
-        if channels[1]["input"] is not None:
-            label.x = window.width / 3
-            label2 = pyglet.text.Label(channels[1]["input"],
-                                    font_size=15,
-                                    x=2 * (window.width / 3),
-                                    y=window.height - 20,
-                                    anchor_x='center',
-                                    anchor_y='center',
-                                    batch = batch)
-            label2.color = (120, 220, 120, 255)                                    
-
-
-    ## If we haven't had a oneshot trigger, process a normal trigger
-    if channels[0]["triggerIndex"] < 0:
-        if not oneShot:
-            lastValue = 10000
-            triggerAttempts = 0
-
-            ## Rising trigger - wait for the value to go below trigger threshold
-            ## and then wait for the value to rise above the trigger
-            while channels[0]["trigger"] > 0 and (triggerAttempts < 10000) and lastValue > channels[0]["trigger"]:
-                lastValue = getSamples()[0]
-                triggerAttempts = triggerAttempts + 1
-            
-            while channels[0]["trigger"] > 0 and (triggerAttempts < 10000) and lastValue < channels[0]["trigger"]:
-                lastValue = getSamples()[0]
-                triggerAttempts = triggerAttempts + 1
-
-            ## Disable the trigger if it timed out
-            if triggerAttempts == 10000:
-                channels[0]["trigger"] = -1
+        ## Spread the channel names out across the top
+        for n, channel in enumerate(channels):
+            text = channel["input"] + describeProcessing(channel)
+            if spectrum and channel["spectrum"] is not None and channel["spectrum"]["readout"] is not None:
+                readout = channel["spectrum"]["readout"]
+                text = (text + ": " + format(readout["fundamental"], ".1f") + "Hz, " + format(readout["level"], ".1f") +
+                        "dB, THD " + format(readout["thd"], ".2f") + "%")
+
+            showLabel("channel" + str(n), text,
+                      font_size=15,
+                      x=(n + 1) * window.width / (len(channels) + 1),
+                      y=window.height - 20,
+                      anchor_x='center',
+                      anchor_y='center',
+                      color=channelColors[n % len(channelColors)])
+
+        if spectrum:
+            showLabel("axis", '0 - ' + format(topFrequency, ".0f") + 'Hz, 0 to -' + str(spectrumRange) + 'dB (' +
+                      spectrumWindow + ' window, ' + spectrumAveraging + ' averaging)',
+                      font_size=10,
+                      x=window.width - 10,
+                      y=5,
+                      anchor_x='right',
+                      anchor_y='bottom',
+                      color=(200, 200, 200, 255))
+
+    ## List each channel's measurements in the bottom right, in its colour
+    if not spectrum:
+        for n, channel in enumerate(channels):
+            showLabel("measure" + str(n), describeMeasurements(channelMeasurements[n]),
+                      font_size=10,
+                      x=window.width - 10,
+                      y=5 + 16 * (len(channels) - 1 - n),
+                      anchor_x='right',
+                      anchor_y='bottom',
+                      color=channelColors[n % len(channelColors)])
+
+    ## When scrolled back through a port's history, show when the view's samples arrived
+    source = channels[triggerChannel]
+    if source["triggerIndex"] >= 0 and source["blockTimes"] is not None:
+        viewTime = indexTime(source, source["triggerIndex"])
+        newestTime = indexTime(source, source["writeIndex"] - 1)
+
+        if not numpy.isnan(viewTime) and not numpy.isnan(newestTime):
+            showLabel("paused", 'Paused at ' + time.strftime("%H:%M:%S", time.localtime(viewTime)) + ', ' +
+                      format(newestTime - viewTime, ".1f") + 's before the newest samples',
+                      font_size=10,
+                      x=window.width - 10,
+                      y=window.height - 40,
+                      anchor_x='right',
+                      anchor_y='top',
+                      color=(200, 200, 200, 255))
+
+    ## Find this frame's samples. The reader threads keep everything in the ring
+    ## buffer, and we find the trigger in it. This keeps us drawing the most current
+    ## data, avoiding latency issues (single channel), and differing data rates (dual channel)
+    sampleCount = iterCount
+    triggerBegin = time.perf_counter()
+    spanStarts, frameStarts = positionFrame(iterCount)
+    recordTime("trigger", time.perf_counter() - triggerBegin)
+
+    ## If we're trying for a One Shot trigger, remember where we triggered and keep
+    ## showing it. Once the samples after it have filled 1/2 of the data buffer,
+    ## stop capturing.
+    global oneShotStarts
+    if oneShot and channels[0]["triggerIndex"] < 0:
+        if oneShotStarts is None:
+            oneShotStarts = frameStarts
+
+        if oneShotStarts is not None:
+            for n, channel in enumerate(channels):
+                spanStarts[n] = ringIndex(channel, oneShotStarts[n])
+
+            source = channels[triggerChannel]
+            if source["port"] is None or source["samplesRead"] - oneShotStarts[triggerChannel] >= len(source["dataBuffer"]) / 2:
+                for n, channel in enumerate(channels):
+                    channel["triggerIndex"] = spanStarts[n]
+                    channel["oneShotHome"] = spanStarts[n]
+                oneShotStarts = None
+
+    ## In the spectrum view, draw the latest spectrum the worker has for each
+    ## channel, with the loudest bin in each pixel column
+    geometryBegin = time.perf_counter()
+    if spectrum:
+        for n, channel in enumerate(channels):
+            result = channel["spectrum"]
+            if result is None:
+                updateTrace(traces[n], numpy.zeros(0), numpy.zeros(0))
+                continue
+
+            xPos = numpy.arange(len(result["power"])) * result["binWidth"] / topFrequency * window.width
+            shown = xPos <= window.width
+            levels = 10 * numpy.log10(result["power"][shown] + 1e-20)
+            columns = numpy.flatnonzero(numpy.diff(xPos[shown].astype(int), prepend = -1))
+            levels = numpy.maximum.reduceat(levels, columns)
+
+            yPos = numpy.clip(1 + levels / spectrumRange, 0, 1) * (window.height - 80)
+            updateTrace(traces[n], xPos[columns], yPos + 40)
+
+        dataX = getSpan(channels[0], spanStarts[0], channels[0]["frameCount"])
+
+    ## If we're in XY mode, take samples as X and Y. Both are resampled onto the
+    ## timebase of the trigger channel, so that each point is one moment in time.
+    elif xy:
+        spans = []
+        for channel, start in zip(channels[:2], spanStarts[:2]):
+            span = getSpan(channel, start, channel["frameCount"] + 1)
+            positions = channel["frameShift"] + numpy.arange(iterCount) / channel["frameScale"]
+            spans.append(numpy.interp(positions, numpy.arange(len(span)), span) + channel["offset"])
+        dataX, dataY = spans
+
+        xPos = dataX / channels[0]["peak"] * channels[0]["scale"] * (window.width - 80)
+        yPos = dataY / channels[0]["peak"] * channels[0]["scale"] * (window.height - 80)
+        updatePhosphor(xPos[iterCount - xyCount:], yPos[iterCount - xyCount:] + 40)
     else:
-        channels[0]["dataIndex"] = channels[0]["triggerIndex"]
-        channels[1]["dataIndex"] = channels[1]["triggerIndex"]
+        ## Otherwise, take samples for a regular graph. Zoomed out, each pixel
+        ## column shows the full range of the samples that fall into it. Ports that
+        ## are lined up by time are shifted and stretched onto the trigger channel's.
+        for n, channel in enumerate(channels):
+            columns = max(1, int(channel["frameCount"] * channel["zoom"]))
+            positions, data = getTrace(channel, spanStarts[n], channel["frameCount"], columns)
+            data = data + channel["offset"]
 
-    ## Prepare the array that will hold the Pyglet shapes / data points
-    elements = [0]*((2 * iterCount) + int((window.height - 80) / 10))
-    elementIndex = 0
+            xPos = (positions - channel["frameShift"]) * channel["frameScale"] * channel["zoom"]
+            yPos = data / channel["peak"] * channel["scale"] * (window.height - 80)
+            updateTrace(traces[n], xPos, yPos + 40)
 
-    ## Add the graph lines
-    for i in range(0, window.height - 80, 10):
-        if i % 100 == 0:
-            elements[elementIndex] = shapes.Line(0, i + 40, window.width, i + 40, color = (200, 200, 200), width = 1, batch = batch)
-        else:
-            elements[elementIndex] = shapes.Line(0, i + 40, window.width, i + 40, color = (100, 100, 100), width = 1, batch = batch)
-        elementIndex = elementIndex + 1
-    
-    lastYPos = [0, 0]
-    lastXPos = [0, 0]
-    sampleCount = 0
-    yCoord = 0
-    minValue = channels[0]["peak"] + 1
-    maxValue = (channels[0]["peak"] * -1) - 1
-
-    ## Capture a window's worth of data points
-    for i in range(iterCount):
-
-        dataPoint = getSamples()       
-        sampleCount = sampleCount + 1
-
-        ## Apply offset
-        dataX = dataPoint[0] + channels[0]["offset"]
-        if dataX < minValue:
-            minValue = dataX
-        if dataX > maxValue:
-            maxValue = dataX
-
-        dataY = dataPoint[1] + channels[1]["offset"]
-
-        ## If we're trying for a One Shot trigger and we haven't triggered yet and now have a data point above the trigger,
-        ## remember where we triggered and fill 1/2 of the data buffer with samples
-        if oneShot and channels[0]["triggerIndex"] < 0 and dataPoint >= channels[0]["trigger"]:
-            savedDataIndex = channels[0]["dataIndex"]
-            for i in range(int(len(channels[0]["dataBuffer"]) / 4)):
-                dataPoint = getSamples()[0]
-            
-            channels[0]["triggerIndex"] = channels[0]["savedDataIndex"]
-            channels[0]["oneShotHome"] = channels[0]["triggerIndex"]
+            if n == 0:
+                dataX = data
 
-            break
+    recordTime("geometry", time.perf_counter() - geometryBegin)
 
-        ## If we're in XY mode, take samples as X and Y
-        if xy:
-            xPos = int(dataX / channels[0]["peak"] * channels[0]["scale"] * (window.width - 80))
-            yPos = int(dataY / channels[0]["peak"] * channels[0]["scale"] * (window.height - 80))
-            
-            ## If our points are close enough, draw a line between them. Otherwise, use three little dots (rather than a circle) for performance
-            threshold = window.width / 30
-            if abs(lastXPos[0] - xPos) < threshold and abs(lastYPos[0] - yPos) < threshold:
-                elements[elementIndex] = shapes.Line(lastXPos[0], lastYPos[0] + 40, xPos, yPos + 40, color = (120, 120, 220), width = 2, batch = batch)
-                elementIndex = elementIndex + 1
-            else:
-                lineSize = int(window.width / 350)
-                elements[elementIndex] = shapes.Line(xPos - lineSize, yPos + 40, xPos + lineSize, yPos + 40, color = (120, 120, 220), width = lineSize, batch = batch)
-                elementIndex = elementIndex + 1
+    ## The mouse reads time along the trace from the trigger channel's sample rate.
+    ## Vpp is of the first channel's measurements, or of what's drawn until it has some.
+    mouseFrameDuration = iterCount / channels[triggerChannel]["timingRate"]
 
-            lastXPos[0] = xPos
-            lastYPos[0] = yPos
-        else:
-            ## Otherwise, take samples for a regular graph
-            xPos = int(i * channels[0]["zoom"])
-            yPos = int(dataX / channels[0]["peak"] * channels[0]["scale"] * (window.height - 80))
-            
-            if lastXPos[0] > 0:
-                elements[elementIndex] = shapes.Line(lastXPos[0], lastYPos[0] + 40, xPos, yPos + 40, color = (120, 120, 220), width = 1, batch = batch)
-            
-            lastXPos[0] = xPos
-            lastYPos[0] = yPos
-            
-            if channels[1]["input"] is not None:
-                yPos = int(dataY / channels[1]["peak"] * channels[1]["scale"] * (window.height - 80))
-                xPos = int(i * channels[1]["zoom"])
-
-                if lastXPos[1] > 0:
-                    elementIndex = elementIndex + 1
-                    elements[elementIndex] = shapes.Line(lastXPos[1], lastYPos[1] + 40, xPos, yPos + 40, color = (120, 220, 120), width = 1, batch = batch)
-
-                lastYPos[1] = yPos
-                lastXPos[1] = xPos
-
-            elementIndex = elementIndex + 1
-
-    mouseFrameEnd = time.perf_counter()
-    mouseFrameDuration = mouseFrameEnd - frameBegin
-    
     offset = format(mousePos[0] / window.width * mouseFrameDuration, ".5f")
-    dataValue = format(((mousePos[1] - 40) / (window.height - 80)) / channels[0]["scale"] * channels[0]["vref"], ".2f")
-    vpp = format((maxValue - minValue) / channels[0]["peak"] * channels[0]["vref"], ".2f")
+    dataValue = format((((mousePos[1] - 40) / (window.height - 80)) / channels[0]["scale"] - channels[0]["offset"] / channels[0]["peak"]) *
+                       channels[0]["vref"], ".2f")
+    if channelMeasurements[0] is not None:
+        vpp = format(channelMeasurements[0]["vpp"], ".2f")
+    else:
+        vpp = format((dataX.max() - dataX.min()) / channels[0]["peak"] * channels[0]["vref"], ".2f")
 
     anchor_x = 'left'
     if mousePos[0] > (window.width - 250):
@@ -501,62 +3206,103 @@ def on_draw():
         width = abs(mousePos[0] - mouseDragStart[0]) + 1
         height = abs(mousePos[1] - mouseDragStart[1])
 
-        dragRectangle = shapes.BorderedRectangle(startX, startY, width, height, border=1, color = (255, 255, 255), border_color = (255, 255, 255), batch = batch)
-        dragRectangle.opacity = 100
+        if (dragRectangle.x, dragRectangle.y, dragRectangle.width, dragRectangle.height) != (startX, startY, width, height):
+            dragRectangle.position = startX, startY
+            dragRectangle.width = width
+            dragRectangle.height = height
+        dragRectangle.visible = True
 
         dxData = width / window.width * mouseFrameDuration
         dx = format(dxData, ".5f") + "s (" + format(1 / dxData, "5.2f") + "Hz)"
         dy = format(width * mouseFrameDuration, ".5f")
         anchor_x = 'center'
         dv = format(height / (window.height - 80) / channels[0]["scale"] * channels[0]["vref"], ".2f")
-        mouseLabel = pyglet.text.Label('dt: ' + dx + ', dv: ' + dv + "v, Vpp: " +  vpp,
-                                font_size=10,
-                                x=window.width / 2,
-                                y=20,
-                                anchor_x=anchor_x,
-                                anchor_y='bottom',
-                                color=(255, 255, 255, 255),
-                                batch = batch
-                                )
+        text = 'dt: ' + dx + ', dv: ' + dv + "v, Vpp: " +  vpp
+
+        if spectrum:
+            text = ('df: ' + format(width / window.width * topFrequency, ".1f") + 'Hz, dB: ' +
+                    format(height / (window.height - 80) * spectrumRange, ".1f"))
+
+        showLabel("mouse", text,
+                  font_size=10,
+                  x=window.width / 2,
+                  y=20,
+                  anchor_x=anchor_x,
+                  anchor_y='bottom',
+                  color=(255, 255, 255, 255))
     else:
-        mouseLabel = pyglet.text.Label('time: ' + offset + ', value: ' + dataValue + "v, Vpp: " +  vpp,
-                            font_size=10,
-                            x=mousePos[0],
-                            y=mousePos[1] + 5,
-                            anchor_x=anchor_x,
-                            anchor_y='bottom',
-                            color=(255, 120, 120, 255),
-                            batch = batch
-                            )
+        dragRectangle.visible = False
+
+        text = 'time: ' + offset + ', value: ' + dataValue + "v, Vpp: " +  vpp
+
+        if spectrum:
+            text = ('frequency: ' + format(mousePos[0] / window.width * topFrequency, ".1f") + 'Hz, level: ' +
+                    format(((mousePos[1] - 40) / (window.height - 80) - 1) * spectrumRange, ".1f") + "dB")
+
+        showLabel("mouse", text,
+                  font_size=10,
+                  x=mousePos[0],
+                  y=mousePos[1] + 5,
+                  anchor_x=anchor_x,
+                  anchor_y='bottom',
+                  color=(255, 120, 120, 255))
+
+    ## Show how long each stage takes, and what each channel has received
+    if overlayOn:
+        showLabel("overlay", overlayText,
+                  font_name='monospace',
+                  font_size=9,
+                  x=10,
+                  y=window.height - 40,
+                  width=window.width - 20,
+                  anchor_x='left',
+                  anchor_y='top',
+                  multiline=True,
+                  color=(200, 200, 200, 255))
+
+    hideLabels()
 
     ## Clear the window and draw the screen
+    drawBegin = time.perf_counter()
     window.clear()
-    batch.draw()
+    drawTrace(grid, GL_LINES)
+
+    if xy and not spectrum:
+        drawPhosphor(traces[0]["color"])
+    else:
+        for trace in traces:
+            drawTrace(trace, GL_LINE_STRIP)
+
+    hudBatch.draw()
 
     frameEnd = time.perf_counter()
     frameDuration = frameEnd - frameBegin
+    recordTime("draw", frameEnd - drawBegin)
+    recordTime("frame", frameDuration)
 
-    global currentFrame
     currentFrame = (currentFrame + 1) % 1000
 
     ## Update the status
     if currentFrame % 10 == 0:
-        waiting0 = 0
-        waiting1 = 0
+        if overlayOn:
+            overlayText = describeMetrics(metricsSnapshot())
 
-        if channels[0]["port"] is not None:
-            waiting0 = channels[0]["port"].in_waiting
+        waiting = ", ".join(format(channel["samplesNew"], ">4.0f") for channel in channels)
+        resynced = ", ".join(str(channel["bytesSkipped"]) for channel in channels)
 
-        if channels[1]["port"] is not None:
-            waiting1 = channels[1]["port"].in_waiting
+        lostFrames = ""
+        if any(channel["protocol"] == "framed" for channel in channels):
+            lostFrames = ". Dropped/corrupt frames: " + ", ".join(
+                str(channel["framing"]["dropped"]) + "/" + str(channel["framing"]["corrupt"]) for channel in channels)
 
         print("Processing " + format(sampleCount / frameDuration, ">5.0f") +
             " samples per second (" + format(1 / frameDuration, ".1F") +
-            " FPS, " + format(sampleCount, "3.0f") + " SPF. Buffers: " + format(waiting0, ">4.0f") + ", " + format(waiting1, ">4.0f") + ")", end = "\r")
-   
-pyglet.app.run()
-
-if channels[0]["captureFile"] is not None:
-    channels[0]["captureFile"].close()
-if channels[1]["captureFile"] is not None:
-    channels[1]["captureFile"].close()    
\ No newline at end of file
+            " FPS, " + format(sampleCount, "3.0f") + " SPF. Buffers: " + waiting +
+            ". Resynced bytes: " + resynced + lostFrames + ")", end = "\r")
+
+## Frames are drawn from update() rather than on pyglet's own schedule
+pyglet.app.run(None)
+
+for channel in channels:
+    stopReader(channel)
+    stopCapture(channel)